@@ -0,0 +1,64 @@
+#! /usr/bin/python
+
+"""
+Compare lines/sec appended to a build log by the buffered log writer
+in pallet_builder.py against opening, appending and closing the file
+for every line, the way log() used to.
+
+usage: log_writer.py [--lines N] [--width CHARS] [--repeat N]
+
+Each writer runs --repeat times and the best rate is reported, the
+numbers swing a lot between runs on a busy machine.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pallet_builder
+
+
+def reopen_log(logfile, message):
+    with open(logfile, 'a') as logfh:
+        logfh.write(message + '\n')
+
+
+def run(write, logfile, lines, width):
+    line = 'x' * width
+    t0 = time.time()
+    for i in range(lines):
+        write(logfile, line)
+    pallet_builder.close_logs()
+    elapsed = time.time() - t0
+    return lines / elapsed, os.path.getsize(logfile)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=200000)
+    parser.add_argument('--width', type=int, default=80, help='characters per line')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bob-log-bench.')
+    try:
+        print('%-10s %14s %12s' % ('writer', 'lines/sec', 'bytes'))
+        for (name, write) in [ ('reopen', reopen_log), ('buffered', pallet_builder.log) ]:
+            rates = []
+            for i in range(args.repeat):
+                path = os.path.join(workdir, '{0}.{1}'.format(name, i))
+                rate, size = run(write, path, args.lines, args.width)
+                rates.append(rate)
+            print('%-10s %14.0f %12d' % (name, max(rates), size))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
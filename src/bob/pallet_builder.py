@@ -5,22 +5,60 @@ from __future__ import print_function
 import os
 import sys
 import glob
+import json
+import errno
+import fcntl
+import hashlib
+import time
+import atexit
+import resource
 import shutil
+import threading
 import subprocess
-from collections import namedtuple
+from collections import namedtuple, deque
 import re
 from functools import partial
+from contextlib import contextmanager
 import ConfigParser
 
 ExecResults = namedtuple('ExecResults', ['stdout', 'stderr', 'exit_status'])
 
 GLOBAL_BUILD_LOG = '/export/nightly/build_log.txt'
+BUILD_INDEX = '/export/nightly/build_index.json'
+RPM_CACHE = '/export/cache/rpms'
+RPM_CACHE_SIZE = 20 # GB
 
-def exec_cmd(command, obfuscate = None):
+# make reads GNUmakefile ahead of Makefile, so this stands in for the
+# Makefile of a package whose RPMs came from the cache and keeps any
+# target asked of it, the RPM included, from doing anything
+STUB_MAKEFILE = 'GNUmakefile'
+STUB_RULES = '''# written by pallet_builder, this package's RPMs came from the rpm cache
+all: ; @:
+.DEFAULT: ; @:
+'''
+
+# environment variables from stack-build.sh that steer a pallet build
+BUILD_ENV_PREFIXES = ('STACK', 'ROCKS', 'PALLET', 'ROLL')
+
+# lines of output kept in memory when a command's output is streamed to a log
+TAIL_LINES = 1000
+
+# buffered log writes are flushed once this much is pending or this old
+LOG_FLUSH_BYTES = 64 * 1024
+LOG_FLUSH_SECS = 1.0
+
+# rusage counts block I/O in 512 byte units
+BLOCK_BYTES = 512
+
+def exec_cmd(command, obfuscate = None, logfile = None, quiet = False):
     """
     Run shell command, return namedtuple with output and exit status.
     obfuscate is a callable if you wish to log something other than
     the exact command (to protect passwords, etc)
+    quiet keeps the command out of the global build log
+    if logfile is given, output is appended to it line by line as the
+    command runs and only the last TAIL_LINES lines are returned, so
+    long builds use constant memory and can be followed with tail -f
     """
     # turn strings into lists here, so we don't have 'split()'s sprinkled across the code
     try:
@@ -33,19 +71,333 @@ def exec_cmd(command, obfuscate = None):
     # note that this obviously won't avoid it showing up in the output of `ps`
     if not obfuscate:
         obfuscate = str
-    log(GLOBAL_BUILD_LOG, obfuscate(' '.join(command)))
+    shown = obfuscate(' '.join(command))
+    if not quiet:
+        log(GLOBAL_BUILD_LOG, shown)
+    start = time.time()
     proc = subprocess.Popen(
         command,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT
     )
-    output, err = proc.communicate()
+    if not logfile:
+        # stderr goes to stdout, so reading stdout is all communicate() would do
+        output = proc.stdout.read()
+        proc.stdout.close()
+        return ExecResults(output, None, wait_child(proc, shown, start))
+
+    tail = deque(maxlen=TAIL_LINES)
+    writer = get_log(logfile)
+    # readline rather than iterating the pipe, which reads ahead in big blocks
+    for line in iter(proc.stdout.readline, b''):
+        writer.write(line.rstrip('\n'))
+        tail.append(line)
+    proc.stdout.close()
+
+    return ExecResults(''.join(tail), None, wait_child(proc, shown, start))
+
+def wait_child(proc, command, start):
+    """
+    Reap proc with wait4, which gives us the rusage of that one child,
+    record it against the current build phase and return the exit status
+    """
+    pid, status, usage = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    build_stats.command(command, time.time() - start, usage, proc.returncode)
+    return proc.returncode
+
+def usage_delta(before, after):
+    """
+    CPU seconds and I/O bytes between two rusage readings, or in after
+    alone if before is None
+    """
+    if before is None:
+        before = resource.struct_rusage((0,) * len(after))
+    return {
+        'cpu_user': round(after.ru_utime - before.ru_utime, 3),
+        'cpu_sys': round(after.ru_stime - before.ru_stime, 3),
+        'read_bytes': (after.ru_inblock - before.ru_inblock) * BLOCK_BYTES,
+        'write_bytes': (after.ru_oublock - before.ru_oublock) * BLOCK_BYTES,
+    }
+
+class BuildStats(object):
+    """
+    Wall time, CPU time, peak RSS and block I/O of each build phase and
+    of each command run during it, written out as JSON at the end of a build.
+    A phase counts this process and every child it reaped while it ran.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = []
+        self.current = None
+
+    @contextmanager
+    def phase(self, name):
+        record = {'name': name, 'status': 'failed', 'commands': []}
+        self.phases.append(record)
+        self.current = record
+        start = time.time()
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield record
+            record['status'] = 'ok'
+        finally:
+            self.current = None
+            record['wall'] = round(time.time() - start, 3)
+            record['self'] = usage_delta(own, resource.getrusage(resource.RUSAGE_SELF))
+            record['children'] = usage_delta(children, resource.getrusage(resource.RUSAGE_CHILDREN))
+            # ru_maxrss only ever grows for this process, so this is its peak so far
+            record['self']['maxrss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            record['children']['maxrss_kb'] = max([c['maxrss_kb'] for c in record['commands']] or [0])
+
+    def command(self, command, wall, usage, exit_status):
+        if self.current is None:
+            return
+        record = usage_delta(None, usage)
+        record.update({
+            'command': command,
+            'wall': round(wall, 3),
+            'maxrss_kb': usage.ru_maxrss,
+            'exit_status': exit_status,
+        })
+        self.current['commands'].append(record)
+
+    def write(self, path, **info):
+        """
+        Write the summary through a temp file so a reader never sees half of it
+        """
+        summary = dict(info)
+        summary['started'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started))
+        summary['wall'] = round(time.time() - self.started, 3)
+        summary['phases'] = self.phases
+        tmp = '{0}.{1}'.format(path, os.getpid())
+        with open(tmp, 'w') as fh:
+            json.dump(summary, fh, indent=2, sort_keys=True)
+        os.rename(tmp, path)
+
+build_stats = BuildStats()
+
+class BuildIndex(object):
+    """
+    Completed builds, keyed by pallet, branch, commit and a hash of the
+    build.ini, kept as JSON so a polling job can tell a build is already
+    done without touching the ISOs. Updates take a lock file, since builds
+    of different pallets can finish at the same time.
+    """
+
+    def __init__(self, path = BUILD_INDEX):
+        self.path = path
 
-    return ExecResults(output, err, proc.returncode)
+    @staticmethod
+    def key(pallet, branch, commit, config_hash):
+        return '/'.join((pallet, branch, commit, config_hash))
+
+    def load(self):
+        try:
+            with open(self.path) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, key):
+        return self.load().get(key)
+
+    def add(self, key, entry):
+        with open(self.path + '.lock', 'w') as lockfh:
+            fcntl.flock(lockfh, fcntl.LOCK_EX)
+            index = self.load()
+            index[key] = entry
+            tmp = '{0}.{1}'.format(self.path, os.getpid())
+            with open(tmp, 'w') as fh:
+                json.dump(index, fh, indent=2, sort_keys=True)
+            os.rename(tmp, self.path)
+
+class RpmCache(object):
+    """
+    RPMs built from one package directory, stored under a key made from
+    the directory's git tree and the build environment, so a package that
+    hasn't changed since some earlier build can take the RPMs from then.
+    Once the cache outgrows limit bytes the least recently used entries go.
+    """
+
+    def __init__(self, root = RPM_CACHE, limit = None):
+        self.root = root
+        self.limit = limit
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """
+        list of (arch, path) of the RPMs stored for key, None if there are none
+        """
+        path = self.path(key)
+        if not os.path.isdir(path):
+            return None
+        # the entry's mtime is when it was last used, for prune()
+        os.utime(path, None)
+        rpms = []
+        for arch in sorted(os.listdir(path)):
+            for name in sorted(os.listdir(os.path.join(path, arch))):
+                rpms.append((arch, os.path.join(path, arch, name)))
+        return rpms
+
+    def put(self, key, rpms):
+        """
+        store the (arch, path) RPMs for key, through a temp directory so a
+        reader sees all of them or nothing
+        """
+        path = self.path(key)
+        if os.path.isdir(path):
+            return
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp = '{0}.{1}'.format(path, os.getpid())
+        for arch, rpm in rpms:
+            if not os.path.isdir(os.path.join(tmp, arch)):
+                os.makedirs(os.path.join(tmp, arch))
+            shutil.copy(rpm, os.path.join(tmp, arch))
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # another build stored the same package first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def prune(self):
+        """
+        remove the least recently used entries until the cache is no
+        bigger than limit, returns how many went
+        """
+        if not self.limit or not os.path.isdir(self.root):
+            return 0
+        entries = []
+        total = 0
+        for prefix in os.listdir(self.root):
+            for key in os.listdir(os.path.join(self.root, prefix)):
+                path = os.path.join(self.root, prefix, key)
+                # skip the temp directories of puts still going on
+                if '.' in key or not os.path.isdir(path):
+                    continue
+                size = 0
+                for dirpath, dirs, files in os.walk(path):
+                    size += sum(os.path.getsize(os.path.join(dirpath, name)) for name in files)
+                entries.append((os.stat(path).st_mtime, size, path))
+                total += size
+
+        removed = 0
+        for mtime, size, path in sorted(entries):
+            if total <= self.limit:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
+
+class LogWriter(object):
+    """
+    Timestamped records appended to one log file that stays open.
+    Pending records are flushed once there are LOG_FLUSH_BYTES of them,
+    once the oldest is LOG_FLUSH_SECS old (by the next write or the
+    background flusher, whichever comes first), and at exit. Builders
+    share log files, so a flush is one write of whole records to an
+    O_APPEND descriptor and never tears a line into another's.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.lock = threading.Lock()
+        self.records = []
+        self.pending = 0
+        self.oldest = None
+        # the timestamp is formatted once a second, not once a record
+        self.second = None
+        self.stamp = None
+
+    def write(self, message):
+        now = time.time()
+        with self.lock:
+            if int(now) != self.second:
+                self.second = int(now)
+                self.stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))
+            record = '{0} {1}\n'.format(self.stamp, message)
+            self.records.append(record)
+            self.pending += len(record)
+            if self.oldest is None:
+                self.oldest = now
+            if self.pending >= LOG_FLUSH_BYTES or now - self.oldest >= LOG_FLUSH_SECS:
+                self._flush()
+
+    def flush(self, max_age = 0):
+        with self.lock:
+            if self.oldest is not None and time.time() - self.oldest >= max_age:
+                self._flush()
+
+    def _flush(self):
+        if self.records:
+            os.write(self.fd, ''.join(self.records))
+        self.records = []
+        self.pending = 0
+        self.oldest = None
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            os.close(self.fd)
+
+
+_log_writers = {}
+_log_lock = threading.Lock()
+_log_flusher = None
+_log_stop = threading.Event()
+
+def get_log(logfile):
+    """
+    The LogWriter for logfile, opened on first use, which also starts
+    the background flusher.
+    """
+    global _log_flusher
+    with _log_lock:
+        if _log_flusher is None:
+            _log_stop.clear()
+            _log_flusher = threading.Thread(target=_flush_logs)
+            _log_flusher.daemon = True
+            _log_flusher.start()
+        if logfile not in _log_writers:
+            _log_writers[logfile] = LogWriter(logfile)
+        return _log_writers[logfile]
+
+def _flush_logs():
+    while not _log_stop.wait(LOG_FLUSH_SECS):
+        with _log_lock:
+            writers = list(_log_writers.values())
+        for writer in writers:
+            writer.flush(LOG_FLUSH_SECS)
+
+def close_logs():
+    """
+    Flush and close every log and stop the flusher, so it isn't left
+    running into interpreter shutdown. Logging again reopens them.
+    """
+    global _log_flusher
+    with _log_lock:
+        for writer in _log_writers.values():
+            writer.close()
+        _log_writers.clear()
+        flusher = _log_flusher
+        _log_flusher = None
+        _log_stop.set()
+    if flusher is not None:
+        flusher.join()
+
+atexit.register(close_logs)
 
 def log(logfile, message):
-    with open(logfile, 'a') as logfh:
-        logfh.write(message + '\n')
+    get_log(logfile).write(message)
 
 def fail(logfile, message):
     log(logfile, message)
@@ -77,13 +429,21 @@ def git_get_current_commit_id():
     else:
         return results.stdout.strip()
 
+def git_resolve(rev):
+    """
+    short commit id of rev, None if it doesn't resolve
+    """
+    results = exec_cmd(['git', 'rev-parse', '--short', '--verify', '--quiet', rev + '^{commit}'], quiet=True)
+    if not results.exit_status:
+        return results.stdout.strip()
+
 def git_checkout(branch = 'master'):
     results = exec_cmd('git checkout --force {0}'.format(branch))
     if results.exit_status:
         log(GLOBAL_BUILD_LOG, 'git checkout failed')
 
-def git_reset():
-    results = exec_cmd('git reset --hard')
+def git_reset(commit = None):
+    results = exec_cmd('git reset --hard {0}'.format(commit or ''))
     if results.exit_status:
         log(GLOBAL_BUILD_LOG, 'git reset failed')
 
@@ -98,6 +458,7 @@ class Builder(object):
         self.global_delivery_dir = '/export/nightly'
         self.system_build_dir = '/export/build'
         self.global_build_log = self.global_delivery_dir + '/build_log.txt'
+        self.build_index = BuildIndex(self.global_delivery_dir + '/build_index.json')
 
         defaults = {
             'branch': 'master',
@@ -106,6 +467,8 @@ class Builder(object):
             'skip_bootstrap': False,
             'skip_stamp': False,
             'versionfile': 'version.mk',
+            'rpm_cache': RPM_CACHE,
+            'rpm_cache_size': str(RPM_CACHE_SIZE),
         }
 
         config = ConfigParser.ConfigParser(defaults)
@@ -128,11 +491,21 @@ class Builder(object):
         self.skip_bootstrap = config.get('build', 'skip_bootstrap')
         self.skip_stamp     = config.get('build', 'skip_stamp')
         self.versionfile    = config.get('build', 'versionfile')
+        self.rpm_cache      = config.get('build', 'rpm_cache')
+
+        try:
+            rpm_cache_size = float(config.get('build', 'rpm_cache_size'))
+        except ValueError:
+            fail(self.global_build_log, 'rpm_cache_size must be a number of GB')
 
         mandatory_options = (self.pallet_name, self.git_username, self.git_password, self.repo_url)
         if None in mandatory_options:
             fail(self.global_build_log, 'not all args specified in build.ini file')
 
+        # any change to the build options means a rebuild, even of a commit already built
+        with open(config_file, 'rb') as configfh:
+            self.config_hash = hashlib.sha256(configfh.read()).hexdigest()
+
         try:
             # check to see if password is a filename
             with open(self.git_password) as pwdfile:
@@ -162,9 +535,25 @@ class Builder(object):
         if self.branch != 'master':
             self.delivery_dir += '_{0}'.format(self.branch)
         self.logfile = '{0}/nightly-{1}-{2}-build.txt'.format(self.delivery_dir, self.pallet_name, self.branch)
+        self.statsfile = '{0}/nightly-{1}-{2}-build.json'.format(self.delivery_dir, self.pallet_name, self.branch)
 
-        self.commit_id = git_get_current_commit_id()
+        self.lockfile = '{0}/.build-{1}-{2}.lock'.format(self.global_delivery_dir, self.pallet_name, self.branch)
+        # the commit to build, if it could be told before touching the working tree
+        self.target_commit = None
+        self.commit_id = None
         self.iso_version = ''
+        self.iso_path = None
+
+        self.rpms_dir = '{0}/build-{1}-{2}/RPMS'.format(self.makefile_dir, self.pallet_name, self.branch)
+        if self.rpm_cache:
+            self.rpm_cache = RpmCache(self.rpm_cache, int(rpm_cache_size * 1024 ** 3))
+        # the ROLLVERSION from the versionfile, before any stamp
+        self.roll_version = ''
+        # package name -> directory and cache key, and the packages and RPM files restored from the cache
+        self.package_dirs = {}
+        self.package_keys = {}
+        self.cached_packages = set()
+        self.restored_rpms = {}
 
 
     def prepare_delivery_dir(self):
@@ -195,7 +584,7 @@ class Builder(object):
 
         git_checkout(self.branch)
         git_clean()
-        git_reset()
+        git_reset(self.target_commit)
 
 
     def pre_make(self):
@@ -206,25 +595,21 @@ class Builder(object):
 
         self._set_build_env_vars()
 
-        results = exec_cmd('make nuke.all')
+        results = exec_cmd('make nuke.all', logfile=self.logfile)
         if results.exit_status:
             log(self.global_build_log, 'error, make nuke.all')
-            log(self.logfile, results.stdout)
 
         if self.skip_bootstrap:
             log(self.global_build_log, 'skipping bootstrap')
             return
 
-        results = exec_cmd('make bootstrap')
+        results = exec_cmd('make bootstrap', logfile=self.logfile)
         if results.exit_status and '''make: *** No rule to make target `bootstrap'.''' in results.stdout:
             log(self.global_build_log, 'no target for make bootstrap, ignoring')
-        else:
-            #log(self.global_build_log, 'error, make bootstrap')
-            log(self.logfile, results.stdout)
 
         if self.pallet_name == 'stacki':
             # so nice, we have to bootstrap it twice.
-            results = exec_cmd('make bootstrap')
+            results = exec_cmd('make bootstrap', logfile=self.logfile)
 
 
 
@@ -239,7 +624,8 @@ class Builder(object):
             else:
                 fail(self.global_build_log, 'could not delete build directory')
 
-        self.iso_version = self.get_iso_version()
+        self.roll_version = self.get_iso_version()
+        self.iso_version = self.roll_version
 
         if not self.skip_stamp:
             # stamp with branch name and commit hash
@@ -247,18 +633,192 @@ class Builder(object):
 
         make_pallet_cmd = 'make ROLLVERSION={0}'.format(self.iso_version)
 
-        # make roll
-        results = exec_cmd(make_pallet_cmd)
+        self.restore_cached_rpms()
 
-        log(self.logfile, results.stdout)
+        # make roll, output goes to the pallet log as it is produced
+        try:
+            results = exec_cmd(make_pallet_cmd, logfile=self.logfile)
+        finally:
+            self.remove_stub_makefiles()
 
         # exit if fail
         if results.exit_status:
+            log(self.global_build_log, 'error in make roll, last lines of output:')
+            log(self.global_build_log, results.stdout.rstrip('\n'))
             fail(self.global_build_log, 'error in make roll')
 
         if not self.make_check():
             fail(self.global_build_log, 'error, make manifest-check')
 
+        self.store_built_rpms()
+
+
+    def _package_dirs(self):
+        """
+        map each package's NAME, from the version.mk in its directory
+        under src/, to that directory
+        """
+        packages = {}
+        for path, dirs, files in os.walk('src'):
+            if 'version.mk' not in files:
+                continue
+            with open(os.path.join(path, 'version.mk')) as version_fh:
+                for line in version_fh:
+                    match = re.match(r'\s*NAME\s*=\s*(\S+)', line)
+                    if match:
+                        packages[match.group(1)] = path
+                        break
+        return packages
+
+
+    def _package_keys(self, packages):
+        """
+        cache key of each package: its git tree, the build environment and
+        the unstamped ROLLVERSION. The stamp holds the commit id, keying on
+        it would make every new commit miss every package, so an RPM taken
+        from the cache may carry the stamp of the commit that built it.
+        """
+        results = exec_cmd('git ls-tree -r -d HEAD src/')
+        trees = {}
+        for line in results.stdout.splitlines():
+            info, path = line.split('\t', 1)
+            trees[path] = info.split()[2]
+
+        env = sorted((key, val) for key, val in os.environ.items() if key.startswith(BUILD_ENV_PREFIXES))
+        keys = {}
+        for name, path in packages.items():
+            if path in trees:
+                keys[name] = hashlib.sha256(json.dumps([trees[path], self.roll_version, env])).hexdigest()
+        return keys
+
+
+    def _built_rpms(self):
+        """
+        (arch, path) of each RPM in the build tree
+        """
+        if not os.path.isdir(self.rpms_dir):
+            return []
+        rpms = []
+        for arch in os.listdir(self.rpms_dir):
+            arch_dir = os.path.join(self.rpms_dir, arch)
+            if os.path.isdir(arch_dir):
+                rpms.extend((arch, os.path.join(arch_dir, name))
+                            for name in os.listdir(arch_dir) if name.endswith('.rpm'))
+        return rpms
+
+
+    def restore_cached_rpms(self):
+        """
+        copy the cached RPMs of every unchanged package into the build tree
+        ahead of make, and stand a stub makefile in for the package's own so
+        make roll can't build it again whatever the pallet's rules say
+        """
+        if not self.rpm_cache:
+            return
+        if self.skip_clean:
+            # keys come from the git trees, which an uncleaned tree may not match
+            log(self.global_build_log, 'rpm cache not used with skip_clean')
+            return
+
+        self.package_dirs = self._package_dirs()
+        self.package_keys = self._package_keys(self.package_dirs)
+        try:
+            for name, key in sorted(self.package_keys.items()):
+                rpms = self.rpm_cache.get(key)
+                if rpms is None:
+                    continue
+                for arch, rpm in rpms:
+                    dest_dir = os.path.join(self.rpms_dir, arch)
+                    if not os.path.isdir(dest_dir):
+                        os.makedirs(dest_dir)
+                    dest = os.path.join(dest_dir, os.path.basename(rpm))
+                    shutil.copy(rpm, dest)
+                    st = os.stat(dest)
+                    self.restored_rpms[dest] = (st.st_ino, st.st_mtime)
+                self.cached_packages.add(name)
+                self._stub_makefile(self.package_dirs[name])
+        except (IOError, OSError) as e:
+            # half a package's RPMs is worse than none, make builds them all
+            log(self.global_build_log, 'could not restore cached rpms: {0}'.format(e))
+            self.remove_stub_makefiles()
+            for dest in self.restored_rpms:
+                if os.path.exists(dest):
+                    os.unlink(dest)
+            self.package_keys = {}
+            self.cached_packages = set()
+            self.restored_rpms = {}
+
+
+    def _stub_makefile(self, path):
+        stub = os.path.join(path, STUB_MAKEFILE)
+        if os.path.exists(stub):
+            os.rename(stub, stub + '.stack-cache')
+        with open(stub, 'w') as stub_fh:
+            stub_fh.write(STUB_RULES)
+
+
+    def remove_stub_makefiles(self):
+        """
+        put back what the stub makefiles stood in for
+        """
+        for name in self.cached_packages:
+            stub = os.path.join(self.package_dirs[name], STUB_MAKEFILE)
+            if os.path.exists(stub):
+                os.unlink(stub)
+            if os.path.exists(stub + '.stack-cache'):
+                os.rename(stub + '.stack-cache', stub)
+
+
+    def store_built_rpms(self):
+        """
+        cache the RPMs of the packages that missed, found through the
+        source RPM each one was built from, and log the hits and misses
+        """
+        if not self.package_keys:
+            return
+
+        rebuilt = 0
+        for dest, (ino, mtime) in self.restored_rpms.items():
+            try:
+                st = os.stat(dest)
+            except OSError:
+                continue
+            if (st.st_ino, st.st_mtime) != (ino, mtime):
+                rebuilt += 1
+
+        hits = len(self.cached_packages)
+        message = 'rpm cache: {0} hits, {1} misses, {2} restored RPMs rebuilt by make anyway'.format(
+            hits, len(self.package_keys) - hits, rebuilt)
+        log(self.logfile, message)
+        log(self.global_build_log, message)
+
+        rpms = {}
+        for arch, rpm in self._built_rpms():
+            rpms[os.path.basename(rpm)] = (arch, rpm)
+        if not rpms:
+            return
+
+        # print the file name with the source rpm, rpm may print warnings too
+        results = exec_cmd(['rpm', '-qp', '--qf', '%{NAME}-%{VERSION}-%{RELEASE}.%{ARCH}.rpm %{SOURCERPM}\n'] +
+                           sorted(path for arch, path in rpms.values()))
+        by_package = {}
+        for line in results.stdout.splitlines():
+            fields = line.split()
+            if len(fields) != 2 or fields[0] not in rpms:
+                continue
+            # NAME-VERSION-RELEASE.src.rpm
+            by_package.setdefault(fields[1].rsplit('-', 2)[0], []).append(rpms[fields[0]])
+
+        try:
+            for name, key in self.package_keys.items():
+                if name not in self.cached_packages and name in by_package:
+                    self.rpm_cache.put(key, by_package[name])
+            removed = self.rpm_cache.prune()
+            if removed:
+                log(self.global_build_log, 'rpm cache: removed {0} least recently used entries'.format(removed))
+        except (IOError, OSError) as e:
+            log(self.global_build_log, 'could not store rpms in the cache: {0}'.format(e))
+
 
     def deliver_iso(self):
         log(self.global_build_log, 'Copying iso to delivery directory')
@@ -273,13 +833,13 @@ class Builder(object):
         # copy iso to delivery
         log(self.global_build_log, 'copying {0} to {1}'.format(iso_fname, self.delivery_dir))
         shutil.copy(iso_fname, self.delivery_dir)
+        self.iso_path = os.path.join(self.delivery_dir, os.path.basename(iso_fname))
 
 
     def make_check(self):
-        results = exec_cmd('make manifest-check')
+        results = exec_cmd('make manifest-check', logfile=self.logfile)
         if results.exit_status:
             log(self.global_build_log, 'error, make manifest-check')
-            log(self.logfile, results.stdout)
             return False
         return True
 
@@ -287,7 +847,7 @@ class Builder(object):
     def _set_build_env_vars(self):
         results = exec_cmd(['/bin/bash', '-c', 'source /etc/profile.d/stack-build.sh && env'])
         for var in results.stdout.splitlines():
-            if var.startswith(('STACK', 'ROCKS', 'PALLET', 'ROLL')):
+            if var.startswith(BUILD_ENV_PREFIXES):
                 key, val = var.split('=')
                 os.environ[key] = val
 
@@ -317,13 +877,88 @@ class Builder(object):
 
 
     def do_build(self):
-        log(self.global_build_log, 'starting build job for {0}'.format(self.pallet_name))
-        self.refresh_git_repo()
-        self.prepare_delivery_dir()
-        self.prepare_build_dir()
-        self.pre_make()
-        self.make_pallet()
-        self.deliver_iso()
+        # cron may start us again while a build of this pallet and branch
+        # is still running in the same tree, the newcomer just leaves
+        with open(self.lockfile, 'w') as lockfh:
+            try:
+                fcntl.flock(lockfh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return
+                raise
+
+            self.target_commit = self.upstream_commit()
+            if self.target_commit and self.build_index.get(self.index_key(self.target_commit)):
+                return
+
+            log(self.global_build_log, 'starting build job for {0}'.format(self.pallet_name))
+            try:
+                for phase in (self.refresh_git_repo, self.prepare_delivery_dir, self.prepare_build_dir):
+                    with build_stats.phase(phase.__name__):
+                        phase()
+
+                self.commit_id = git_get_current_commit_id()
+                for phase in (self.pre_make, self.make_pallet, self.deliver_iso):
+                    with build_stats.phase(phase.__name__):
+                        phase()
+                self.record_build(self.index_key(self.target_commit or self.commit_id))
+            finally:
+                # fail() exits mid-phase, the summary is written either way
+                self.write_stats()
+
+
+    def upstream_commit(self):
+        """
+        The commit a build would check out, found without changing the
+        working tree so a poll with nothing new to build stays cheap and
+        quiet: origin's branch after a fetch, or the local branch, tag or
+        commit if there is no such thing or refresh is off. None when the
+        repo isn't cloned yet.
+        """
+        try:
+            os.chdir(self.src_root_dir)
+        except OSError:
+            return None
+
+        if self.skip_refresh:
+            return git_resolve(self.branch)
+
+        results = exec_cmd('git fetch --quiet origin', quiet=True)
+        if results.exit_status:
+            log(self.global_build_log, 'git fetch failed')
+            return None
+        return git_resolve('origin/' + self.branch) or git_resolve(self.branch)
+
+
+    def index_key(self, commit):
+        return BuildIndex.key(self.pallet_name, self.branch, commit, self.config_hash)
+
+
+    def record_build(self, key):
+        try:
+            self.build_index.add(key, {
+                'pallet': self.pallet_name,
+                'branch': self.branch,
+                'commit': self.commit_id,
+                'config_hash': self.config_hash,
+                'iso': self.iso_path,
+                'built': time.strftime('%Y-%m-%d %H:%M:%S'),
+            })
+        except (IOError, OSError) as e:
+            log(self.global_build_log, 'could not update build index: {0}'.format(e))
+
+
+    def write_stats(self):
+        try:
+            build_stats.write(
+                self.statsfile,
+                pallet=self.pallet_name,
+                branch=self.branch,
+                commit=self.commit_id,
+                status='ok' if all(p['status'] == 'ok' for p in build_stats.phases) else 'failed',
+            )
+        except (IOError, OSError) as e:
+            log(self.global_build_log, 'could not write build stats: {0}'.format(e))
 
 
 if __name__ == '__main__':
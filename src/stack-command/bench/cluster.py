@@ -0,0 +1,183 @@
+#! /opt/stack/bin/python3
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+"""
+Run 'stack sync host file' against simulated clusters, to catch
+regressions in the sync engine without a real cluster.
+
+The real Command.run is used, with the host list swapped for made-up
+hosts and ssh/scp swapped for fakessh.sh, which models each link's
+latency, bandwidth and failure rate. Host-to-host hops (relay=tree,
+relay=subnet) only cost the latency. For each cluster size the
+command runs in its own python process and we report its wall time,
+CPU time and peak RSS, and the most processes it had running under it
+at once. Needs the stack command framework, so run it on a frontend.
+
+usage: cluster.py [--hosts 10,100,1000,5000] [--latency S]
+		  [--bandwidth MB/s] [--failure RATE] [--size BYTES]
+		  [param=value ...]
+
+Extra param=value arguments go to the command, e.g. engine=asyncio
+parallel=1000 relay=tree.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import resource
+import tempfile
+import subprocess
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+
+
+class Database(object):
+	"""
+	All the command asks the database for is the frontend's name.
+	"""
+
+	def getHostname(self, name=None):
+		return socket.gethostname()
+
+
+def child(args, params):
+	"""
+	Run the command once and print its numbers as JSON.
+	"""
+	import stack.commands.sync.host.file as sync
+
+	class Bench(sync.Command):
+		def getHostnames(self, names=None, managed_only=0):
+			return [ 'bench%05d' % i for i in range(args.child) ]
+
+	#
+	# made-up hosts stay out of the frontend's throughput history
+	#
+	sync.history.record = lambda *args: None
+
+	command         = Bench(None)
+	command.db      = Database()
+	command._params = params
+
+	t0 = time.time()
+	command.run(params, [])
+	wall  = time.time() - t0
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+
+	print(json.dumps({
+		'wall'   : wall,
+		'cpu'    : usage.ru_utime + usage.ru_stime,
+		'maxrss' : usage.ru_maxrss,
+		}))
+
+
+def descendants(pid):
+	"""
+	How many processes there are under 'pid'.
+	"""
+	parent = {}
+	for entry in os.listdir('/proc'):
+		if not entry.isdigit():
+			continue
+		try:
+			with open('/proc/%s/stat' % entry) as fin:
+				stat = fin.read()
+		except IOError:
+			continue
+		#
+		# the name in parens may hold spaces, ppid is the
+		# second field after it
+		#
+		parent[int(entry)] = int(stat[stat.rindex(')') + 2:].split()[1])
+
+	count = 0
+	for p in parent:
+		while p in parent and p != pid:
+			p = parent[p]
+		if p == pid:
+			count += 1
+	return count - 1
+
+
+def measure(args, hosts, params, fakebin):
+	env = dict(os.environ)
+	env['PATH']            = '%s:%s' % (fakebin, env.get('PATH', ''))
+	env['BENCH_LATENCY']   = str(args.latency)
+	env['BENCH_BANDWIDTH'] = str(args.bandwidth * 1024 * 1024)
+	env['BENCH_FAILURE']   = str(args.failure)
+
+	cmd  = [ sys.executable, __file__, '--child', str(hosts) ] + \
+	       [ '%s=%s' % item for item in sorted(params.items()) ]
+	proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE)
+
+	peak = 0
+	while proc.poll() is None:
+		peak = max(peak, descendants(proc.pid))
+		time.sleep(0.1)
+
+	out = proc.stdout.read().decode().strip().split('\n')[-1]
+	if proc.returncode:
+		raise RuntimeError('run with %d hosts failed' % hosts)
+	r = json.loads(out)
+	r['procs'] = peak
+	return r
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--hosts', default='10,100,1000,5000',
+			    help='comma separated cluster sizes')
+	parser.add_argument('--latency', type=float, default=0.01,
+			    help='seconds per ssh or scp')
+	parser.add_argument('--bandwidth', type=float, default=100.0,
+			    help='MB/s per host, 0 is unlimited')
+	parser.add_argument('--failure', type=float, default=0.0,
+			    help='fraction of ssh and scp calls that fail')
+	parser.add_argument('--size', type=int, default=1024 * 1024,
+			    help='bytes in the file synced')
+	parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+	(args, extra) = parser.parse_known_args()
+
+	params = dict([ arg.split('=', 1) for arg in extra if '=' in arg ])
+	if args.child:
+		child(args, params)
+		return
+
+	workdir = tempfile.mkdtemp(prefix='stack-sync-bench.')
+	try:
+		fakebin = os.path.join(workdir, 'bin')
+		os.mkdir(fakebin)
+		for tool in [ 'ssh', 'scp' ]:
+			path = os.path.join(fakebin, tool)
+			with open(path, 'w') as fout:
+				fout.write('#!/bin/sh\nexec sh %s %s "$@"\n' %
+					   (os.path.join(BENCH, 'fakessh.sh'), tool))
+			os.chmod(path, 0o755)
+
+		src = os.path.join(workdir, 'payload')
+		with open(src, 'wb') as fout:
+			fout.write(os.urandom(args.size))
+		params.setdefault('src', src)
+		params.setdefault('dest', '/tmp')
+		params.setdefault('report', 'summary')
+
+		print('%8s %8s %8s %10s %12s %8s' %
+		      ('hosts', 'wall', 'cpu', 'rss-MB', 'cpu-ms/host', 'procs'))
+		for hosts in [ int(n) for n in args.hosts.split(',') ]:
+			r = measure(args, hosts, params, fakebin)
+			print('%8d %8.2f %8.2f %10.1f %12.2f %8d' %
+			      (hosts, r['wall'], r['cpu'], r['maxrss'] / 1024.0,
+			       1000.0 * r['cpu'] / hosts, r['procs']))
+	finally:
+		shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+	main()
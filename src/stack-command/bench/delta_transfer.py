@@ -0,0 +1,134 @@
+#! /opt/stack/bin/python3
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+"""
+Compare the delta transfer used by 'stack sync host file delta=true'
+with a full copy, for a large file with a few small edits.
+
+Without a host both sides run locally: the full copy is a plain file
+copy and the delta path is signature + delta + patch in process, so
+the numbers show bytes on the wire and the frontend's CPU cost. With
+--host the file is pushed to that host with scp and with the delta
+engine over ssh.
+
+usage: delta_transfer.py [--size MB] [--edits N] [--host HOST]
+"""
+
+import os
+import io
+import sys
+import time
+import shutil
+import random
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+				'..', 'sync', 'host', 'file'))
+import delta
+
+
+def make_files(workdir, size, edits):
+	"""
+	Write a random basis file and a copy of it with 'edits' small
+	changes, half of them in place and half inserting a few bytes.
+	"""
+	basis = os.path.join(workdir, 'basis')
+	new   = os.path.join(workdir, 'new')
+
+	with open(basis, 'wb') as fout:
+		left = size
+		while left:
+			n = min(left, 1024 * 1024)
+			fout.write(os.urandom(n))
+			left -= n
+
+	offsets = sorted(random.sample(range(size), edits), reverse=True)
+	with open(basis, 'rb') as fin:
+		data = bytearray(fin.read())
+	for (i, offset) in enumerate(offsets):
+		if i % 2:
+			data[offset:offset] = b'# inserted line\n'
+		else:
+			data[offset:offset + 16] = b'# changed line.\n'
+	with open(new, 'wb') as fout:
+		fout.write(data)
+
+	return (basis, new)
+
+
+def local(basis, new, workdir):
+	copy = os.path.join(workdir, 'copy')
+	t0 = time.time()
+	shutil.copyfile(new, copy)
+	full = (os.path.getsize(new), time.time() - t0)
+
+	bs  = delta.blocksize(os.path.getsize(basis))
+	out = os.path.join(workdir, 'patched')
+	t0  = time.time()
+	sig = io.BytesIO()
+	delta.signature(basis, bs, sig)
+	table   = delta.parse_signature(sig.getvalue().decode())
+	records = b''.join(delta.delta(new, table, bs))
+	delta.patch(basis, io.BytesIO(records), out, bs)
+	elapsed = time.time() - t0
+
+	with open(out, 'rb') as a, open(new, 'rb') as b:
+		assert a.read() == b.read(), 'patched file differs'
+
+	return full, (len(sig.getvalue()) + len(records), elapsed)
+
+
+def remote(basis, new, host):
+	path   = '/tmp/stack-sync-bench'
+	bs     = delta.blocksize(os.path.getsize(basis))
+	script = '/opt/stack/bin/python3 %s.py' % path
+
+	subprocess.check_call([ 'scp', '-q', basis, '%s:%s' % (host, path) ])
+	subprocess.check_call([ 'scp', '-q', delta.__file__, '%s:%s.py' % (host, path) ])
+
+	t0 = time.time()
+	subprocess.check_call([ 'scp', '-q', new, '%s:%s.full' % (host, path) ])
+	full = (os.path.getsize(new), time.time() - t0)
+
+	t0 = time.time()
+	sig = subprocess.check_output([ 'ssh', host, '%s signature %s %d' % (script, path, bs) ])
+	table   = delta.parse_signature(sig.decode())
+	records = b''.join(delta.delta(new, table, bs))
+	subprocess.run([ 'ssh', host, '%s patch %s %d' % (script, path, bs) ],
+		       input=records, check=True)
+	elapsed = time.time() - t0
+
+	subprocess.call([ 'ssh', host, 'rm -f %s %s.full %s.py' % (path, path, path) ])
+	return full, (len(sig) + len(records), elapsed)
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--size', type=int, default=256, help='file size in MB')
+	parser.add_argument('--edits', type=int, default=10)
+	parser.add_argument('--host')
+	args = parser.parse_args()
+
+	workdir = tempfile.mkdtemp(prefix='stack-sync-bench.')
+	try:
+		(basis, new) = make_files(workdir, args.size * 1024 * 1024, args.edits)
+		if args.host:
+			(full, part) = remote(basis, new, args.host)
+		else:
+			(full, part) = local(basis, new, workdir)
+	finally:
+		shutil.rmtree(workdir)
+
+	print('%-8s %14s %10s' % ('method', 'wire-bytes', 'seconds'))
+	print('%-8s %14d %10.2f' % ('scp', full[0], full[1]))
+	print('%-8s %14d %10.2f' % ('delta', part[0], part[1]))
+	print('delta sends %.2f%% of the bytes' % (100.0 * part[0] / full[0]))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,86 @@
+#! /opt/stack/bin/python3
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+"""
+Compare files/sec for a tree of small files pushed to a host with
+'scp -r' against the single tar stream 'stack sync host file' uses
+for directories, with each compression choice.
+
+usage: directory_transfer.py --host HOST [--files N] [--size BYTES]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+				'..', 'sync', 'host', 'file'))
+import archive
+
+
+def make_tree(workdir, files, size):
+	"""
+	A tree shaped roughly like site-packages: 100 files per
+	directory, two levels deep.
+	"""
+	top = os.path.join(workdir, 'tree')
+	for i in range(files):
+		d = os.path.join(top, 'pkg%03d' % (i // 10000), 'mod%03d' % (i // 100 % 100))
+		if not os.path.isdir(d):
+			os.makedirs(d)
+		with open(os.path.join(d, 'file%05d.py' % i), 'wb') as fout:
+			fout.write(b'# generated\n' * (size // 12 + 1))
+	return top
+
+
+def scp(src, host, dest):
+	subprocess.check_call([ 'scp', '-q', '-r', src, '%s:%s' % (host, dest) ])
+
+
+def tar(src, host, dest, compress):
+	cmd  = [ 'ssh', host, archive.untar_cmd(src, dest, compress) ]
+	proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+	with proc.stdin:
+		for chunk in archive.stream(src, compress):
+			proc.stdin.write(chunk)
+	if proc.wait():
+		raise IOError('untar on %s failed' % host)
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--host', required=True)
+	parser.add_argument('--files', type=int, default=20000)
+	parser.add_argument('--size', type=int, default=2048, help='bytes per file')
+	args = parser.parse_args()
+
+	dest    = '/tmp/stack-sync-bench'
+	workdir = tempfile.mkdtemp(prefix='stack-sync-bench.')
+	runs    = [ ('scp -r', lambda: scp(src, args.host, dest)) ]
+	for compress in [ 'none', 'gzip', 'xz' ]:
+		runs.append(('tar/%s' % compress,
+			     lambda c=compress: tar(src, args.host, dest, c)))
+
+	print('%-10s %10s %12s' % ('method', 'seconds', 'files/sec'))
+	try:
+		src = make_tree(workdir, args.files, args.size)
+		for (name, run) in runs:
+			subprocess.check_call([ 'ssh', args.host, 'rm -rf %s' % dest ])
+			t0 = time.time()
+			run()
+			elapsed = time.time() - t0
+			print('%-10s %10.2f %12.0f' % (name, elapsed, args.files / elapsed))
+	finally:
+		subprocess.call([ 'ssh', args.host, 'rm -rf %s' % dest ])
+		shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,94 @@
+#! /opt/stack/bin/python3
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+"""
+Compare the frontend cost of the thread and asyncio engines behind
+'stack sync host file' against a local fake transport.
+
+Each fake host is a child 'sh' that sleeps for the link latency and
+then reads the bytes we feed it, so the engines manage real processes
+and pipes without any network. Each engine runs in its own python
+process so peak RSS and CPU time are its own; both are also reported
+per 1,000 hosts.
+
+usage: engine.py [--hosts N] [--parallel N] [--latency S] [--size BYTES]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+				'..', 'sync', 'host', 'file'))
+import scheduler
+
+ENGINES = {
+	'thread'  : scheduler.Scheduler,
+	'asyncio' : scheduler.AsyncScheduler,
+	}
+
+
+def child(args):
+	"""
+	Run one engine and print its numbers as JSON.
+	"""
+	data = b'\0' * args.size
+	cmd  = [ 'sh', '-c', 'sleep %s; exec cat > /dev/null' % args.latency ]
+
+	tasks = [ scheduler.Task('host%05d' % i,
+				 [ scheduler.Step(cmd, 'copy', lambda task: [ data ]) ])
+		  for i in range(args.hosts) ]
+
+	t0 = time.time()
+	ENGINES[args.child](args.parallel).run(tasks)
+	wall  = time.time() - t0
+	usage = resource.getrusage(resource.RUSAGE_SELF)
+
+	print(json.dumps({
+		'wall'   : wall,
+		'cpu'    : usage.ru_utime + usage.ru_stime,
+		'maxrss' : usage.ru_maxrss,
+		'failed' : len([ t for t in tasks if t.status != 'ok' ]),
+		}))
+
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--hosts', type=int, default=1000)
+	parser.add_argument('--parallel', type=int, default=1000)
+	parser.add_argument('--latency', type=float, default=1.0,
+			    help='seconds each fake transfer takes')
+	parser.add_argument('--size', type=int, default=65536,
+			    help='bytes fed to each fake host')
+	parser.add_argument('--child', choices=sorted(ENGINES), help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.child:
+		child(args)
+		return
+
+	print('%-8s %8s %8s %10s %12s %12s %7s' %
+	      ('engine', 'wall', 'cpu', 'rss-MB', 'cpu/1k', 'rss-MB/1k', 'failed'))
+	per = 1000.0 / args.hosts
+	for engine in sorted(ENGINES, reverse=True):
+		out = subprocess.check_output([ sys.executable, __file__,
+			'--child', engine,
+			'--hosts', str(args.hosts),
+			'--parallel', str(args.parallel),
+			'--latency', str(args.latency),
+			'--size', str(args.size) ])
+		r   = json.loads(out.decode())
+		rss = r['maxrss'] / 1024.0
+		print('%-8s %8.2f %8.2f %10.1f %12.2f %12.1f %7d' %
+		      (engine, r['wall'], r['cpu'], rss, r['cpu'] * per, rss * per, r['failed']))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,64 @@
+#! /bin/sh
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+#
+# Stand-in for ssh and scp used by cluster.py: nothing leaves the
+# frontend. Every call takes its data (stdin for ssh, the local files
+# for scp), waits the link latency plus the time the data would take
+# at the link bandwidth and then fails with the configured
+# probability, exiting 255 like ssh does when it can't get through.
+# Remote commands are not run, so probes come back empty and every
+# host looks like it needs the file. Kept to sh and awk so starting
+# thousands of them doesn't cost more than the engine being measured.
+#
+# usage: fakessh.sh ssh|scp [ssh or scp arguments]
+#
+# Configured from the environment: BENCH_LATENCY (seconds),
+# BENCH_BANDWIDTH (bytes/sec, 0 is unlimited) and BENCH_FAILURE
+# (0 to 1).
+#
+
+tool=$1
+shift
+
+case " $* " in
+*" -O "*)
+	exit 0
+	;;
+esac
+
+if [ "$tool" = ssh ]; then
+	bytes=$(wc -c)
+else
+	#
+	# the local files are the operands before the last one
+	#
+	bytes=0
+	prev=
+	for arg in "$@"; do
+		if [ -f "$prev" ]; then
+			bytes=$((bytes + $(wc -c < "$prev")))
+		fi
+		prev=$arg
+	done
+fi
+
+exec awk -v bytes="$bytes" -v seed=$$ \
+	-v latency="${BENCH_LATENCY:-0.01}" \
+	-v bandwidth="${BENCH_BANDWIDTH:-0}" \
+	-v failure="${BENCH_FAILURE:-0}" '
+BEGIN {
+	srand(seed)
+	delay = latency
+	if (bandwidth > 0)
+		delay += bytes / bandwidth
+	system("sleep " delay)
+	if (rand() < failure) {
+		print "connection closed by remote host" > "/dev/stderr"
+		exit 255
+	}
+	exit 0
+}'
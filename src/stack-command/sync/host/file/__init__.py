@@ -4,12 +4,25 @@
 #
 
 import sys
-import stack.api as api
+import time
+import shlex
 import stack.commands
 import os.path
+import ipaddress
 from stack.exception import *
-from stack.commands.sync.host import Parallel
-from stack.commands.sync.host import timeout
+from stack.commands.sync.host.file.relay import plan_tree, plan_staged, relay_cmd
+from stack.commands.sync.host.file.scheduler import Step, Task, Gate, Scheduler, AsyncScheduler, stats
+from stack.commands.sync.host.file.checksum import digest, digest_cmd, parse
+from stack.commands.sync.host.file.remote import target, script, ssh, close, upload, read
+import stack.commands.sync.host.file.remote as remote
+import stack.commands.sync.host.file.delta as delta
+import stack.commands.sync.host.file.chunk as chunk
+import stack.commands.sync.host.file.archive as archive
+import stack.commands.sync.host.file.pull as pull
+import stack.commands.sync.host.file.bundle as bundle
+import stack.commands.sync.host.file.history as history
+import stack.commands.sync.host.file.watch as watch
+from stack.commands.sync.host.file.throttle import Throttle
 
 
 class Command(stack.commands.sync.host.command):
@@ -22,11 +35,226 @@ class Command(stack.commands.sync.host.command):
 	<param type='string' name='dest' optional='0'>
         </param>
 
+	<param type='string' name='manifest'>
+	File listing many files to sync at once, one per line as
+
+	  src dest [mode=0644] [owner=user:group] [service=name]
+
+	(# starts a comment). Each host gets all of them in one tar
+	stream over one ssh, checks them and puts each in place with
+	its mode (the src's if not given) and owner, then restarts
+	every service the manifest names once. Use instead of src and
+	dest; can not be combined with relay, checksum, delta,
+	chunksize or transport=http.
+	</param>
+
 	<param type='string' name='service'>
 	Service to restart if you've added a service
-	related file.
+	related file. Each host restarts it as soon as its own copy
+	has landed and checks out.
+	</param>
+
+	<param type='int' name='batch'>
+	With service, restart hosts in waves of this many: the next
+	wave starts once every restart in the current one is done.
+	Default is no waves.
+	</param>
+
+	<param type='int' name='maxrestart'>
+	With service, the most hosts restarting it at the same time.
+	Default is no limit.
+	</param>
+
+	<param type='string' name='relay'>
+	How the file is distributed. 'none' (the default) copies it
+	from the frontend to every host. 'tree' has hosts that
+	already hold the file forward it to the next hosts, so the
+	copy finishes in log(N) rounds and only a few of the copies
+	leave the frontend. 'subnet' groups the hosts by network, sends
+	one copy to a leader in each subnet and lets the leaders relay
+	it within their subnet, so each subnet is crossed into once.
+	A host the relay didn't reach gets the file from the frontend.
+	Relaying needs an ssh agent holding a key the hosts accept
+	(SSH_AUTH_SOCK set): it is forwarded so each relaying host can
+	ssh to the next.
+	</param>
+
+	<param type='int' name='fanout'>
+	With relay=tree or relay=subnet, the number of hosts each
+	holder sends the file to per round. Default is 1.
+	</param>
+
+	<param type='int' name='prefix'>
+	With relay=subnet, group hosts by this prefix length of their
+	address (e.g. 24 for one /24 per rack) instead of by the
+	network they are on in the database.
+	</param>
+
+	<param type='int' name='parallel'>
+	Maximum number of hosts copied to at the same time. The rest
+	wait in a queue and start as running copies finish. Default
+	is 64.
+	</param>
+
+	<param type='string' name='engine'>
+	What drives the ssh and scp processes: 'thread' (the default)
+	runs a thread per transfer in flight, 'asyncio' runs them all
+	from one event loop, which uses far less memory and CPU on the
+	frontend when parallel is in the thousands.
+	</param>
+
+	<param type='string' name='rate'>
+	Cap on what the frontend sends to all hosts together, in MB/s.
+	While the hosts are slower than the cap more transfers are
+	started (up to parallel); once it is reached the rest wait.
+	Default is no cap.
+	</param>
+
+	<param type='string' name='hostrate'>
+	Cap on what the frontend sends to any one host, in MB/s.
+	Default is no cap.
+	</param>
+
+	<param type='int' name='retries'>
+	How many more times to try a host whose transfer failed, timed
+	out or was killed as a straggler. Retries go to the back of the
+	queue after a backoff that doubles each time. A host whose
+	service restart failed is not retried, and neither are the
+	digest checks of checksum and dryrun. Default is 2.
+	</param>
+
+	<param type='int' name='backoff'>
+	Seconds to wait before the first retry of a host. Default is 1.
+	</param>
+
+	<param type='string' name='straggler'>
+	A host whose transfer has sent nothing for 30 seconds or, once
+	a few hosts are done, runs at less than 1/this of their median
+	throughput is flagged as a straggler in the report. 0 turns
+	this off. Default is 4.
+	</param>
+
+	<param type='bool' name='killstragglers'>
+	If true, stragglers with retries left are killed and retried
+	instead of just flagged. Default is false.
+	</param>
+
+	<param type='bool' name='dryrun'>
+	If true, transfer nothing: check the digest of every host's
+	copy in parallel and report which hosts would be updated, the
+	bytes that would be sent (whole files, even with delta or
+	chunksize) and an estimate of the seconds it would take, based
+	on the throughput of earlier runs. A directory src is assumed
+	to need updating on every host that answers. Default is false.
+	</param>
+
+	<param type='bool' name='watch'>
+	If true, keep running and push src again whenever it changes
+	(inotify, or polling where that isn't available) until
+	interrupted. Only the changed files are sent, and for a
+	directory src, files removed from it are removed on the hosts,
+	with dest being the directory that mirrors src. Run a normal sync
+	first; watching starts from the state the hosts are in. A host
+	that misses a push gets those files with the next one. Can not
+	be combined with relay, checksum, delta, chunksize,
+	transport=http, manifest or dryrun. Default is false.
+	</param>
+
+	<param type='int' name='debounce'>
+	With watch, edits less than this many seconds apart are pushed
+	together. Default is 1.
+	</param>
+
+	<param type='int' name='quiet'>
+	With watch and service, restart the service on the hosts that
+	got pushes only after this many seconds without another push,
+	so a burst of edits restarts it once. Default is 10.
+	</param>
+
+	<param type='int' name='deadline'>
+	Seconds the whole sync may take. Transfers still running when
+	it passes are cancelled, hosts that haven't started are
+	skipped, and both are reported. Default is no deadline.
+	</param>
+
+	<param type='int' name='timeout'>
+	Seconds a single host may take before its transfer is killed.
+	Default is no limit.
+	</param>
+
+	<param type='bool' name='checksum'>
+	If true, compare the sha256 of src with the copy each host
+	already has and only transfer to the hosts where it differs.
+	Only works when src is a file. Default is false.
+	</param>
+
+	<param type='bool' name='delta'>
+	If true, send only the parts of src that changed. Each host
+	sends rolling checksums of the blocks of its current copy and
+	gets back references to those blocks plus the new data, like
+	rsync. Worth it for large files with small edits. Only works
+	when src is a file. Default is false.
+	</param>
+
+	<param type='int' name='chunksize'>
+	Send files larger than this many MB in chunks of that size. Each
+	host keeps the chunks that arrived intact next to dest, so a
+	transfer that dies part way resumes from there on the next run,
+	and the file is only put in place once every chunk and the
+	whole file check out. Only works when src is a file. Default is
+	to send files whole.
+	</param>
+
+	<param type='string' name='rollback'>
+	All or nothing: if more than this fraction of the hosts fail
+	(0 means any), every host gets its previous file back, in
+	parallel, and has the service restarted again if it was.
+	Otherwise the kept copies are removed. Files are always written
+	to a temp file, checked against their sha256 and renamed into
+	place, so a service never reads half a file; this also keeps
+	the old file until the whole cluster is done. Only works when
+	src is a file. Default is off.
+	</param>
+
+	<param type='string' name='transport'>
+	'scp' (the default) pushes the file from the frontend over
+	ssh. 'http' publishes it on the frontend's web server under a
+	temporary content-addressed URL; each host pulls it, checks its
+	sha256 and moves it into place, and the URL is removed
+	afterwards. Only works when src is a file.
+	</param>
+
+	<param type='int' name='segments'>
+	With transport=http, the number of parallel Range requests
+	each host splits its download into. Default is 4.
+	</param>
+
+	<param type='bool' name='archive'>
+	If src is a directory, send it to each host as a single tar
+	stream over one ssh channel instead of with scp -r, which
+	costs a round trip per file. Default is true.
+	</param>
+
+	<param type='string' name='compress'>
+	Compression for the archive stream: none, gzip, bzip2 or xz.
+	Default is none, which is fastest on a LAN.
+	</param>
+
+	<param type='int' name='persist'>
+	All ssh traffic to a host, the copy and the service restart,
+	shares one multiplexed connection. This is how many seconds
+	that connection stays open once idle, so a sync run soon after
+	skips the ssh handshake. 0 closes it when the sync is done.
+	Default is 60.
 	</param>
 	
+	<param type='string' name='report'>
+	'hosts' (the default) lists each host with its status, exit
+	code, the step it ended on, bytes sent, ssh connect time,
+	transfer time, throughput in MB/s, whether it straggled and
+	why it was retried. 'summary' shows totals for the whole run
+	instead. Both honor output-format.
+	</param>
 	
 	<example cmd='sync host file src=/etc/motd dest=/tmp'>
 	Giving no hostname or regex will sync
@@ -37,55 +265,841 @@ class Command(stack.commands.sync.host.command):
 		dest=/etc/sysconfig/docker service=docker'>
 	Sync docker config and restart service
 	</example>
+
+	<example cmd='sync host file src=/export/images/big.img dest=/state relay=tree'>
+	Push a large image to all backends, relaying it host to host.
+	</example>
 	"""
 
 	def run(self, params, args):
-		src,dest,svc = self.fillParams([
+		(src, dest, svc, relay, fanout, parallel,
+		 deadline, timeout, checksum, use_delta, use_archive,
+		 compress, persist, batch, maxrestart, transport,
+		 segments, report, engine, prefix, rate,
+		 hostrate, chunksize, manifest, retries, backoff,
+		 straggler, killstragglers, dryrun, use_watch,
+		 debounce, quiet, rollback) = self.fillParams([
                         ('src', None),
                         ('dest', None),
-                        ('service', None)
+                        ('service', None),
+                        ('relay', 'none'),
+                        ('fanout', '1'),
+                        ('parallel', '64'),
+                        ('deadline', None),
+                        ('timeout', None),
+                        ('checksum', 'false'),
+                        ('delta', 'false'),
+                        ('archive', 'true'),
+                        ('compress', 'none'),
+                        ('persist', '60'),
+                        ('batch', None),
+                        ('maxrestart', None),
+                        ('transport', 'scp'),
+                        ('segments', '4'),
+                        ('report', 'hosts'),
+                        ('engine', 'thread'),
+                        ('prefix', None),
+                        ('rate', None),
+                        ('hostrate', None),
+                        ('chunksize', None),
+                        ('manifest', None),
+                        ('retries', '2'),
+                        ('backoff', '1'),
+                        ('straggler', '4'),
+                        ('killstragglers', 'false'),
+                        ('dryrun', 'false'),
+                        ('watch', 'false'),
+                        ('debounce', '1'),
+                        ('quiet', '10'),
+                        ('rollback', None)
                         ])
 
 		recurse = False
 
 		hosts = self.getHostnames(args, managed_only=1)
 		me = self.db.getHostname('localhost')
+		hosts = [ host for host in hosts if host != me ]
 
-				
-		if not src:
-			raise ParamError(self,'src', "- no source is given.")
+		files = []
+		if manifest:
+			if src or dest:
+				raise ParamError(self, 'manifest', 'can not be used with src or dest')
+			files = self.getPairs(manifest)
+		else:
+			if not src:
+				raise ParamError(self,'src', "- no source is given.")
 
-		if not os.path.isfile(src):
-			if os.path.isdir(src):
-				recurse = True
-			else:
-				raise CommandError(self, '%s is not a file or a directory' % src)
-
-		if not dest:
-			raise ParamError(self,'dest', "- no destination is given.")
-			
-		threads = []
-		for host in hosts:
-			if me != host:
-				if recurse:
-					cmd = 'scp -r %s %s:%s ' % (src,host,dest)
+			if not os.path.isfile(src):
+				if os.path.isdir(src):
+					recurse = True
 				else:
-					cmd = 'scp %s %s:%s ' % (src,host,dest)
+					raise CommandError(self, '%s is not a file or a directory' % src)
 
+			if not dest:
+				raise ParamError(self,'dest', "- no destination is given.")
+
+		if report not in [ 'hosts', 'summary' ]:
+			raise ParamError(self, 'report', 'must be "hosts" or "summary"')
+
+		engines = { 'thread': Scheduler, 'asyncio': AsyncScheduler }
+		if engine not in engines:
+			raise ParamError(self, 'engine', 'must be "thread" or "asyncio"')
+		engine = engines[engine]
+
+		if relay not in [ 'none', 'tree', 'subnet' ]:
+			raise ParamError(self, 'relay', 'must be "none", "tree" or "subnet"')
+		if relay != 'none' and not os.environ.get('SSH_AUTH_SOCK'):
+			raise ParamError(self, 'relay', 'needs an ssh agent to forward (SSH_AUTH_SOCK is not set)')
+		if prefix:
 			try:
-				p = Parallel(cmd)
-				p.start()
-				threads.append(p)
-			except:
-				pass
+				prefix = int(prefix)
+			except ValueError:
+				prefix = -1
+			if not 0 <= prefix <= 32:
+				raise ParamError(self, 'prefix', 'must be between 0 and 32')
+
+		fanout   = self.getCount('fanout', fanout)
+		parallel = self.getCount('parallel', parallel)
+		if deadline:
+			deadline = time.time() + self.getCount('deadline', deadline)
+		if timeout:
+			timeout = self.getCount('timeout', timeout)
+		try:
+			retries = int(retries)
+		except ValueError:
+			retries = -1
+		if retries < 0:
+			raise ParamError(self, 'retries', 'must be zero or more')
+		backoff   = self.getCount('backoff', backoff)
+		straggler = self.getFactor('straggler', straggler)
+		killstragglers = self.str2bool(killstragglers)
+
+		checksum = self.str2bool(checksum)
+		if checksum and recurse:
+			raise ParamError(self, 'checksum', 'only works when src is a file')
+		use_delta = self.str2bool(use_delta)
+		if use_delta and recurse:
+			raise ParamError(self, 'delta', 'only works when src is a file')
+		if transport not in [ 'scp', 'http' ]:
+			raise ParamError(self, 'transport', 'must be "scp" or "http"')
+		if transport == 'http' and recurse:
+			raise ParamError(self, 'transport', 'http only works when src is a file')
+		if transport == 'http' and use_delta:
+			raise ParamError(self, 'transport', 'http can not be used with delta')
+		segments = self.getCount('segments', segments)
+		if chunksize:
+			chunksize = self.getCount('chunksize', chunksize) * 1024 * 1024
+			if recurse:
+				raise ParamError(self, 'chunksize', 'only works when src is a file')
+			if use_delta or transport == 'http':
+				raise ParamError(self, 'chunksize', 'can not be used with delta or transport=http')
+
+		use_archive = recurse and self.str2bool(use_archive)
+		if compress not in archive.COMPRESS:
+			raise ParamError(self, 'compress', 'must be one of %s' %
+				', '.join(sorted(archive.COMPRESS)))
+
+		if files:
+			for (name, used) in [ ('relay', relay != 'none'),
+					      ('checksum', checksum),
+					      ('delta', use_delta),
+					      ('chunksize', chunksize),
+					      ('transport', transport == 'http') ]:
+				if used:
+					raise ParamError(self, name, 'can not be used with manifest')
+
+		if rollback is not None:
+			try:
+				rollback = float(rollback)
+			except ValueError:
+				rollback = -1
+			if not 0 <= rollback < 1:
+				raise ParamError(self, 'rollback', 'must be a fraction from 0 up to 1')
+			if recurse:
+				raise ParamError(self, 'rollback', 'only works when src is a file')
+
+		use_watch = self.str2bool(use_watch)
+		if use_watch:
+			for (name, used) in [ ('relay', relay != 'none'),
+					      ('checksum', checksum),
+					      ('delta', use_delta),
+					      ('chunksize', chunksize),
+					      ('transport', transport == 'http'),
+					      ('manifest', files),
+					      ('dryrun', self.str2bool(dryrun)),
+					      ('rollback', rollback is not None) ]:
+				if used:
+					raise ParamError(self, name, 'can not be used with watch')
+			debounce = self.getCount('debounce', debounce)
+			quiet    = self.getCount('quiet', quiet)
+
+		try:
+			remote.persist = int(persist)
+		except ValueError:
+			remote.persist = -1
+		if remote.persist < 0:
+			raise ParamError(self, 'persist', 'must be zero or more seconds')
+
+		gate = None
+		if svc or bundle.services(files):
+			if batch:
+				batch = self.getCount('batch', batch)
+			if maxrestart:
+				maxrestart = self.getCount('maxrestart', maxrestart)
+			gate = Gate(batch, maxrestart)
+
+		rate      = self.getRate('rate', rate)
+		hostrate  = self.getRate('hostrate', hostrate)
+		throttle  = None
+		if rate or hostrate:
+			throttle = Throttle(rate, hostrate)
+
+		scheduler = engine(parallel, deadline, timeout, throttle,
+				   retries, backoff, straggler, killstragglers)
+		if use_watch:
+			self.watchSrc(scheduler, hosts, src, dest, recurse, svc, gate,
+				      debounce, quiet)
+			return
+
+		skipped   = []
+		local     = None
+		dryrun    = self.str2bool(dryrun)
+		mode      = None
+		if src and not recurse:
+			local = digest(src)
+			mode  = os.stat(src).st_mode & 0o7777
+
+		digests = []
+		if files:
+			size    = sum([ os.path.getsize(pair.src) for pair in files ])
+			digests = [ digest(pair.src) for pair in files ]
+		else:
+			size = self.getSize(src)
+
+		if dryrun:
+			self.dryRun(scheduler, hosts, src, dest, files, digests, local,
+				    size, parallel, report, me)
+			if not remote.persist:
+				engine(parallel).run([ Task(host, [ Step(close(host), 'close') ])
+							 for host in hosts ])
+			return
+
+		#
+		# one ssh per host for the digest of its current copy,
+		# hosts that already match are left alone
+		#
+		if checksum:
+			probes = [ Task(host, [ Step(digest_cmd(host, src, dest), 'digest') ],
+					retries=0) for host in hosts ]
+			for task in scheduler.run(probes):
+				if parse(task.output) == local:
+					skipped.append(task.host)
+			hosts = [ host for host in hosts if host not in skipped ]
+
+		subnets = {}
+		if relay == 'subnet':
+			subnets = self.getSubnets(hosts + [ me ], prefix)
+			groups  = {}
+			for host in hosts:
+				groups.setdefault(subnets.get(host), []).append(host)
+			#
+			# a host we know no subnet for shares none with the
+			# others, it gets its copy from us in the first round
+			#
+			unknown = groups.pop(None, [])
+			rounds  = plan_staged([ groups[key] for key in sorted(groups, key=str) ],
+					      fanout)
+			rounds[0].extend([ (None, host) for host in unknown ])
+		elif relay == 'tree':
+			rounds = plan_tree(hosts, fanout)
+		else:
+			rounds = [ [ (None, host) for host in hosts ] ]
+
+		failed    = set()
+		tasks     = []
+		url       = None
+		manifest  = None
+		plans     = None
+
+		if use_delta and hosts:
+			plans = delta.Plans(src, delta.blocksize(size))
+
+		if chunksize and size > chunksize and hosts:
+			manifest = chunk.manifest(src, chunksize)
+
+		if transport == 'http' and hosts:
+			frontend = self.getHostAttr('localhost', 'Kickstart_PrivateAddress')
+			url = 'http://%s/%s' % (frontend, pull.publish(src, local))
+
+		began = time.time()
+
+		def build(source, host):
+			if source:
+				cmd  = relay_cmd(source, host, src, dest, recurse,
+						 mode, local)
+				task = Task(host, [ Step(cmd, 'copy') ], size, source, retries=0)
+			elif files:
+				task = self.bundleTask(host, files, digests,
+						       svc, gate)
+			elif use_delta:
+				task = self.deltaTask(host, src, dest, local, plans)
+			elif manifest:
+				task = self.chunkTask(host, src, dest, chunksize,
+						      manifest)
+			elif use_archive:
+				task = self.archiveTask(host, src, dest, compress)
+			elif url:
+				#
+				# httpd does the sending, so the best
+				# we can do is have curl hold back
+				#
+				limit = hostrate
+				if rate:
+					limit = min(limit or rate,
+						    rate // min(parallel, len(hosts)))
+				task = self.pullTask(host, src, dest, url, size,
+						     local, segments, limit)
+			elif not recurse:
+				task = self.uploadTask(host, src, dest, local)
+			else:
+				cmd  = relay_cmd(source, host, src, dest, recurse)
+				task = Task(host, [ Step(cmd, 'copy') ], size)
+			if svc and not files:
+				task.steps.extend(self.restartSteps(host, src, dest,
+								    svc, local, gate))
+			if rollback is not None:
+				cmd = self.keepCmd(src, dest, files, remote.backup())
+				task.steps.insert(0, Step(ssh(host, cmd), 'backup'))
+
+			#
+			# time the ssh handshake on its own, the
+			# steps after it reuse the connection
+			#
+			cmd = ssh(source or host, 'true')
+			task.steps.insert(0, Step(cmd, 'connect'))
+			return task
+
+		#
+		# a round has to land before its targets can relay the
+		# file on. If a relay source failed, its targets get the
+		# file straight from the frontend instead, and so does a
+		# target the relay couldn't get it to.
+		#
+		try:
+			for pairs in rounds:
+				jobs = []
+				for (source, host) in pairs:
+					if source in failed:
+						source = None
+					jobs.append(build(source, host))
+
+				scheduler.run(jobs)
+				relayed = [ i for (i, task) in enumerate(jobs)
+					    if task.source and task.status != 'ok' ]
+				direct  = [ build(None, jobs[i].host) for i in relayed ]
+				scheduler.run(direct)
+				for (i, task) in zip(relayed, direct):
+					task.retried = jobs[i].retried + \
+						[ '%s from %s in %s' % (jobs[i].status,
+									jobs[i].source, jobs[i].step) ]
+					jobs[i] = task
+
+				for task in jobs:
+					if task.status != 'ok':
+						failed.add(task.host)
+				tasks.extend(jobs)
+		finally:
+			if url:
+				pull.unpublish(local)
+
+		#
+		# all or nothing: past the allowed failures every host goes
+		# back to its previous file, otherwise the old copies go.
+		# This runs past the deadline, which is often what failed
+		# the hosts in the first place, so only timeout bounds it.
+		#
+		rolledback = None
+		if rollback is not None and tasks:
+			cleanup = engine(parallel, timeout=timeout)
+			bad = [ t for t in tasks if t.status != 'ok' ]
+			if len(bad) > rollback * len(tasks):
+				rolledback = self.rollBack(cleanup, tasks, src, dest,
+							   files, svc)
+			else:
+				cmd = self.keepCmd(src, dest, files, remote.discard())
+				cleanup.run([ Task(t.host, [ Step(ssh(t.host, cmd), 'discard') ],
+						     retries=0) for t in tasks ])
+
+		samples = {}
+		for task in tasks:
+			transfer = self.transferTime(task)
+			if task.status == 'ok' and transfer and task.bytes():
+				samples[task.host] = (task.bytes() / transfer,
+						      task.times.get('connect', 0.0))
+		history.record(samples, sum([ t.bytes() for t in tasks if not t.source ]),
+			       time.time() - began)
+
+		if not remote.persist:
+			engine(parallel).run([ Task(host, [ Step(close(host), 'close') ])
+						 for host in hosts + skipped ])
+
+		self.beginOutput()
+		if report == 'summary':
+			for (name, value) in stats(tasks):
+				self.addOutput(me, [ name, value ])
+			if relay != 'none':
+				self.addOutput(me, [ 'rounds', len(rounds) ])
+			if relay == 'subnet':
+				#
+				# what crossed between subnets vs. what would
+				# have with every copy coming from us
+				#
+				def crosses(a, b):
+					return subnets.get(a) is None or \
+						subnets.get(a) != subnets.get(b)
+
+				done   = [ t for t in tasks if t.status == 'ok' ]
+				staged = sum([ t.bytes() for t in done
+					       if crosses(t.source or me, t.host) ])
+				direct = size * len([ t for t in done if crosses(me, t.host) ])
+				self.addOutput(me, [ 'subnets', len(set(subnets.get(h) for h in hosts)) ])
+				self.addOutput(me, [ 'cross-subnet-bytes', staged ])
+				self.addOutput(me, [ 'cross-subnet-saved', direct - staged ])
+			self.addOutput(me, [ 'frontend-bytes',
+				sum([ t.bytes() for t in tasks if not t.source ]) ])
+			self.addOutput(me, [ 'total-bytes', size * len(hosts) ])
+			if rolledback is not None:
+				self.addOutput(me, [ 'rolled-back', rolledback ])
+			if checksum:
+				self.addOutput(me, [ 'skipped', len(skipped) ])
+				self.addOutput(me, [ 'updated', len([ t for t in tasks if t.status == 'ok' ]) ])
+			self.endOutput(header=['host', 'stat', 'value'], trimOwner=False)
+		else:
+			for task in tasks:
+				self.addOutput(task.host, self.hostReport(task))
+			for host in skipped:
+				self.addOutput(host, [ 'skipped', None, None, 0, None, None, None,
+						       False, None ])
+			self.endOutput(header=['host', 'status', 'rc', 'step', 'bytes',
+					       'connect', 'transfer', 'throughput',
+					       'straggler', 'retried'],
+				       trimOwner=False)
+
+
+	def getSubnets(self, hosts, prefix=None):
+		"""
+		Map each host to the subnet of its default interface (or
+		its first one with an address). With a prefix the subnet
+		is the address' /prefix, otherwise the network it is on in
+		the database. Hosts with no address are left out.
+		"""
+		networks = {}
+		for row in self.call('list.network'):
+			if row.get('address') and row.get('mask'):
+				networks[row['network']] = ipaddress.ip_network(
+					'%s/%s' % (row['address'], row['mask']), strict=False)
+
+		found = {}
+		for row in self.call('list.host.interface', hosts):
+			if not row.get('ip'):
+				continue
+			if row['host'] in found and not row.get('default'):
+				continue
+			if prefix is not None:
+				subnet = ipaddress.ip_interface('%s/%d' % (row['ip'], prefix)).network
+			else:
+				subnet = networks.get(row.get('network'))
+			found[row['host']] = subnet
+
+		return dict([ (host, subnet) for (host, subnet) in found.items()
+			      if subnet is not None ])
+
+
+	def hostReport(self, task):
+		"""
+		The report row for a host. Transfer time is everything but
+		the handshake, the check and the restart.
+		"""
+		connect  = task.times.get('connect', 0.0)
+		transfer = self.transferTime(task)
+		rate     = None
+		if transfer and task.status == 'ok':
+			rate = round(task.bytes() / transfer / (1024 * 1024), 2)
+
+		return [ task.status, task.rc, task.step, task.bytes(),
+			 round(connect, 3), round(transfer, 3), rate,
+			 task.straggler, '; '.join(task.retried) or None ]
+
+
+	def transferTime(self, task):
+		return sum([ t for (name, t) in task.times.items()
+			     if name not in [ 'connect', 'verify', 'restart' ] ])
+
+
+	def dryRun(self, scheduler, hosts, src, dest, files, digests, local,
+		   size, parallel, report, me):
+		"""
+		Ask every host for the digest of its copy and report which
+		of them a real run would update, the bytes that would move
+		and how long it should take going by earlier runs.
+		"""
+		probes = []
+		for host in hosts:
+			if files:
+				cmd = ssh(host, bundle.verify_cmd(files, digests))
+			elif local:
+				cmd = digest_cmd(host, src, dest)
+			else:
+				cmd = ssh(host, 'true')
+			probes.append(Task(host, [ Step(cmd, 'probe') ], retries=0))
 
 		#
-		# collect the threads
+		# ssh exits 255 when it can't get through, anything else
+		# comes from the command on the host
 		#
-		for thread in threads:
-			thread.join(timeout)
+		action = {}
+		for task in scheduler.run(probes):
+			if task.status in [ 'timeout', 'cancelled', 'straggler' ] or task.rc == 255:
+				action[task.host] = 'unreachable'
+			elif files:
+				action[task.host] = 'update' if task.rc else 'current'
+			elif local:
+				current = parse(task.output) == local
+				action[task.host] = 'current' if current else 'update'
+			else:
+				action[task.host] = 'update'
+
+		update = [ host for host in hosts if action[host] == 'update' ]
+		(total, each) = history.estimate(history.load(), update, size, parallel)
+
+		self.beginOutput()
+		if report == 'summary':
+			for name in [ 'update', 'current', 'unreachable' ]:
+				self.addOutput(me, [ name, len([ h for h in hosts
+							     if action[h] == name ]) ])
+			self.addOutput(me, [ 'total-bytes', size * len(update) ])
+			self.addOutput(me, [ 'estimate', round(total, 1) if total is not None else None ])
+			self.endOutput(header=['host', 'stat', 'value'], trimOwner=False)
+		else:
+			for host in hosts:
+				if action[host] == 'update':
+					estimate = each.get(host)
+					self.addOutput(host, [ 'update', size,
+						round(estimate, 1) if estimate is not None else None ])
+				else:
+					self.addOutput(host, [ action[host], 0, None ])
+			self.endOutput(header=['host', 'action', 'bytes', 'estimate'],
+				       trimOwner=False)
+
+
+	def watchSrc(self, scheduler, hosts, src, dest, recurse, svc, gate,
+		     debounce, quiet):
+		"""
+		Push what changes under src until interrupted. Each batch of
+		edits goes to every host in one tar stream; a host that
+		misses a batch gets it with the next one. The service is
+		restarted once things have been quiet for a while.
+		"""
+		root    = os.path.abspath(src.rstrip('/'))
+		batcher = watch.Batcher(watch.watcher(src), debounce)
+		owed    = dict([ (host, set()) for host in hosts ])
+		restart = set()
+		due     = None
+
+		def where(path):
+			if recurse:
+				return os.path.join(dest, os.path.relpath(path, root))
+			return dest
+
+		def say(msg):
+			print('%s %s' % (time.strftime('%H:%M:%S'), msg), flush=True)
+
+		say('watching %s' % src)
+		try:
+			while True:
+				timeout = None
+				if due is not None:
+					timeout = max(0, due - time.time())
+				batch = batcher.next(timeout)
+
+				if batch:
+					(changed, removed) = batch
+					paths = set([ path for (path, isdir) in changed + removed ])
+					dirs  = set([ path for (path, isdir) in removed if isdir ])
+					tasks = []
+					for host in hosts:
+						owed[host] |= paths
+						task = self.watchTask(host, sorted(owed[host]), dirs,
+								      where, recurse)
+						if task:
+							tasks.append(task)
+					for task in scheduler.run(tasks):
+						if task.status == 'ok':
+							owed[task.host] = set()
+							restart.add(task.host)
+					failed = [ t.host for t in tasks if t.status != 'ok' ]
+					say('pushed %d changed, %d removed to %d hosts%s' %
+					    (len(changed), len(removed), len(tasks) - len(failed),
+					     ', failed: %s' % ' '.join(failed) if failed else ''))
+					if svc and restart:
+						due = time.time() + quiet
+
+				if due is not None and time.time() >= due:
+					self.watchRestart(scheduler, restart, svc, gate, say)
+					restart = set()
+					due     = None
+		except KeyboardInterrupt:
+			if due is not None:
+				self.watchRestart(scheduler, restart, svc, gate, say)
+		finally:
+			batcher.watcher.close()
+
+
+	def watchTask(self, host, paths, dirs, where, recurse):
+		"""
+		The push of 'paths' to a host: the ones still there go in
+		a bundle, the ones gone are removed.
+		"""
+		pairs   = []
+		digests = []
+		files   = []
+		for path in paths:
+			if os.path.isfile(path):
+				try:
+					digests.append(digest(path))
+				except IOError:
+					continue
+				pairs.append(bundle.Pair(path, where(path)))
+			elif recurse and not os.path.lexists(path):
+				if path in dirs:
+					continue
+				files.append(where(path))
+
+		steps = []
+		if pairs:
+			steps.append(Step(ssh(host, bundle.install_cmd(pairs, digests)), 'bundle',
+					  lambda task: bundle.stream(pairs, read)))
+		if files or dirs:
+			steps.append(Step(ssh(host, bundle.remove_cmd(files,
+						[ where(d) for d in dirs ])), 'remove'))
+		if not steps:
+			return None
+		return Task(host, steps)
+
+
+	def watchRestart(self, scheduler, hosts, svc, gate, say):
+		cmd   = 'systemctl daemon-reload && systemctl restart %s' % svc
+		tasks = scheduler.run([ Task(host, [ Step(ssh(host, cmd), 'restart', gate=gate) ])
+					for host in sorted(hosts) ])
+		failed = [ t.host for t in tasks if t.status != 'ok' ]
+		say('restarted %s on %d hosts%s' %
+		    (svc, len(tasks) - len(failed),
+		     ', failed: %s' % ' '.join(failed) if failed else ''))
+
+
+	def keepCmd(self, src, dest, files, snippet):
+		"""
+		Shell command that runs a backup/restore/discard snippet for
+		every file the sync installs.
+		"""
+		pairs = [ (pair.src, pair.dest) for pair in files ] or [ (src, dest) ]
+		return '; '.join([ '%s%s' % (target(s, d), snippet) for (s, d) in pairs ])
+
+
+	def rollBack(self, scheduler, tasks, src, dest, files, svc):
+		"""
+		Put the previous files back on every host we synced, in
+		parallel, restarting the service where it was restarted
+		with the new file. Only hosts whose backup step ran are
+		touched: on the others a copy kept by some earlier aborted
+		run would land over the live file. Returns how many hosts
+		went back.
+		"""
+		services = bundle.services(files)
+		if svc and svc not in services:
+			services.append(svc)
+
+		tasks = [ task for task in tasks if 'backup' in task.times ]
+		undo  = []
+		for task in tasks:
+			steps = [ Step(ssh(task.host, self.keepCmd(src, dest, files,
+								   remote.restore())), 'restore') ]
+			if services and 'restart' in task.times:
+				cmd = 'systemctl daemon-reload && systemctl restart %s' % \
+					' '.join([ shlex.quote(s) for s in services ])
+				steps.append(Step(ssh(task.host, cmd), 'restart'))
+			undo.append(Task(task.host, steps))
+
+		count = 0
+		for (task, back) in zip(tasks, scheduler.run(undo)):
+			if back.status == 'ok':
+				count += 1
+				if task.status == 'ok':
+					task.status = 'rolled-back'
+			else:
+				task.status = 'rollback-failed'
+				task.step   = back.step
+				task.error += back.error
+		return count
+
+
+	def restartSteps(self, host, src, dest, svc, local, gate):
+		"""
+		Steps that follow a host's copy: check the copy (files only)
+		and restart the service once the gate lets us.
+		"""
+		steps = []
+		if local:
+			cmd = target(src, dest) + 'echo "%s  $f" | sha256sum -c --status' % local
+			steps.append(Step(ssh(host, cmd), 'verify'))
+
+		cmd = 'systemctl daemon-reload && systemctl restart %s' % svc
+		steps.append(Step(ssh(host, cmd), 'restart', gate=gate))
+		return steps
+
+
+	def bundleTask(self, host, pairs, digests, svc, gate):
+		"""
+		Stream every file of the manifest in one tar, check them in
+		place and restart each service they name once.
+		"""
+		services = bundle.services(pairs)
+		if svc and svc not in services:
+			services.append(svc)
+
+		steps = [ Step(ssh(host, bundle.install_cmd(pairs, digests)), 'bundle',
+			       lambda task: bundle.stream(pairs, read)) ]
+		if services:
+			steps.append(Step(ssh(host, bundle.verify_cmd(pairs, digests)), 'verify'))
+			cmd = 'systemctl daemon-reload && systemctl restart %s' % \
+				' '.join([ shlex.quote(s) for s in services ])
+			steps.append(Step(ssh(host, cmd), 'restart', gate=gate))
+		return Task(host, steps)
+
+
+	def deltaTask(self, host, src, dest, sha, plans):
+		"""
+		Fetch the host's block signature, then stream it the delta
+		against it. Hosts with the same signature share one plan.
+		"""
+		bs    = plans.bs
+		where = target(src, dest)
+
+		def patch(task):
+			return delta.render(src, plans.get(task.output))
+
+		return Task(host, [
+			Step(ssh(host, where + script(delta, 'signature "$f" %d' % bs)), 'signature'),
+			Step(ssh(host, where + script(delta, 'patch "$f" %d %s' % (bs, sha))),
+			     'patch', patch)
+			])
+
+
+	def chunkTask(self, host, src, dest, chunksize, manifest):
+		"""
+		Ask the host which chunks it already has staged, then stream
+		it the rest and have it assemble the file.
+		"""
+		(hashes, sha) = manifest
+		mode  = os.stat(src).st_mode & 0o7777
+		where = target(src, dest)
+
+		def chunks(task):
+			held = chunk.parse_have(task.output)
+			return chunk.stream(src, chunksize, hashes, held, read)
+
+		return Task(host, [
+			Step(ssh(host, where + script(chunk, 'have "$f"')), 'have'),
+			Step(ssh(host, where + script(chunk, 'receive "$f" %s %o' % (sha, mode))),
+			     'chunks', chunks)
+			])
+
+
+	def archiveTask(self, host, src, dest, compress):
+		cmd = ssh(host, archive.untar_cmd(src, dest, compress))
+		return Task(host, [
+			Step(cmd, 'archive', lambda task: archive.stream(src, compress))
+			])
+
+
+	def uploadTask(self, host, src, dest, sha):
+		mode = os.stat(src).st_mode & 0o7777
+		cmd  = ssh(host, target(src, dest) + upload(mode, sha))
+		return Task(host, [ Step(cmd, 'upload', lambda task: read(src)) ])
+
+
+	def pullTask(self, host, src, dest, url, size, sha, segments, rate):
+		mode = os.stat(src).st_mode & 0o7777
+		cmd  = target(src, dest) + pull.fetch_cmd(url, size, sha, mode,
+							    segments, rate)
+		task = Task(host, [ Step(ssh(host, cmd), 'pull') ])
+		task.size = size
+		return task
+
+
+	def getPairs(self, manifest):
+		try:
+			with open(manifest) as fin:
+				pairs = bundle.parse(fin)
+		except IOError as e:
+			raise CommandError(self, 'can not read manifest: %s' % e)
+		except ValueError as e:
+			raise CommandError(self, '%s %s' % (manifest, e))
+
+		if not pairs:
+			raise CommandError(self, '%s lists no files' % manifest)
+		for pair in pairs:
+			if not os.path.isfile(pair.src):
+				raise CommandError(self, '%s is not a file' % pair.src)
+		return pairs
+
+
+	def getFactor(self, name, value):
+		"""
+		A multiple greater than 1 from the command line, None for 0.
+		"""
+		try:
+			value = float(value)
+		except ValueError:
+			value = -1
+		if value == 0:
+			return None
+		if value <= 1:
+			raise ParamError(self, name, 'must be 0 (off) or more than 1')
+		return value
+
+
+	def getRate(self, name, value):
+		"""
+		MB/s from the command line as bytes/sec, None if unset.
+		"""
+		if not value:
+			return None
+		try:
+			value = float(value)
+		except ValueError:
+			value = 0
+		if value <= 0:
+			raise ParamError(self, name, 'must be a positive number of MB/s')
+		return int(value * 1024 * 1024)
+
+
+	def getCount(self, name, value):
+		try:
+			value = int(value)
+		except ValueError:
+			value = 0
+		if value < 1:
+			raise ParamError(self, name, 'must be a positive integer')
+		return value
+
+
+	def getSize(self, path):
+		if not os.path.isdir(path):
+			return os.path.getsize(path)
 
-		if svc:
-			cmd = 'systemctl daemon-reload'
-			cmd += 'systemctl restart %s' % svc
-			api.Call('run.host',[hosts, cmd])
+		size = 0
+		for (root, dirs, files) in os.walk(path):
+			for f in files:
+				size += os.path.getsize(os.path.join(root, f))
+		return size
@@ -0,0 +1,62 @@
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+#
+# Directory copies as one tar stream per host instead of scp -r,
+# which pays a round trip for every file in the tree.
+#
+
+import os
+import shlex
+import subprocess
+
+COMPRESS = {
+	'none'  : '',
+	'gzip'  : 'z',
+	'bzip2' : 'j',
+	'xz'    : 'J',
+	}
+
+
+def tar_cmd(src, compress='none'):
+	"""
+	argv that writes a tar of directory 'src' to stdout.
+	"""
+	src = os.path.abspath(src.rstrip('/'))
+	return [ 'tar', '-C', os.path.dirname(src),
+		 '-c%sf' % COMPRESS[compress], '-', os.path.basename(src) ]
+
+
+def untar_cmd(src, dest, compress='none'):
+	"""
+	Shell command run on the host to unpack the stream into 'dest'
+	with the same result as 'scp -r src host:dest': if dest is a
+	directory the tree lands underneath it, otherwise dest becomes
+	the copy. Like scp, files are owned by the user unpacking them
+	rather than keeping the frontend's uid and gid.
+	"""
+	flag = COMPRESS[compress]
+	dest = shlex.quote(dest)
+	return 'if [ -d %s ]; then tar -C %s --no-same-owner -x%sf -; ' \
+	       'else mkdir -p %s && tar -C %s --no-same-owner --strip-components=1 -x%sf -; fi' % \
+	       (dest, dest, flag, dest, dest, flag)
+
+
+def stream(src, compress='none', blocksize=64 * 1024):
+	"""
+	Generate the tar stream of 'src' as byte strings.
+	"""
+	proc = subprocess.Popen(tar_cmd(src, compress), stdout=subprocess.PIPE)
+	try:
+		for chunk in iter(lambda: proc.stdout.read(blocksize), b''):
+			yield chunk
+	except GeneratorExit:
+		proc.kill()
+		proc.wait()
+		raise
+	finally:
+		proc.stdout.close()
+	if proc.wait():
+		raise IOError('tar of %s failed' % src)
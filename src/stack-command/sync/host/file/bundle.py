@@ -0,0 +1,153 @@
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+#
+# Many files to a host in one go. The files of a manifest travel as a
+# single tar stream over one ssh; the host unpacks it into a scratch
+# directory, checks every file and only then puts each in place with
+# its mode and owner.
+#
+
+import os
+import shlex
+import tarfile
+import time
+
+from stack.commands.sync.host.file.remote import target
+
+BLOCK = tarfile.BLOCKSIZE
+
+
+class Pair(object):
+	"""
+	One manifest line: copy 'src' to 'dest', optionally with a
+	'mode' (int), 'owner' (user[:group]) and a 'service' to restart
+	afterwards.
+	"""
+
+	def __init__(self, src, dest, mode=None, owner=None, service=None):
+		self.src     = src
+		self.dest    = dest
+		self.mode    = mode
+		self.owner   = owner
+		self.service = service
+
+
+def parse(lines):
+	"""
+	Pairs from manifest lines of the form
+
+		src dest [mode=0644] [owner=user:group] [service=name]
+
+	Blank lines and lines starting with # are ignored. Raises
+	ValueError naming the line for anything else.
+	"""
+	pairs = []
+	for (n, line) in enumerate(lines, 1):
+		words = shlex.split(line, comments=True)
+		if not words:
+			continue
+		if len(words) < 2:
+			raise ValueError('line %d: needs a src and a dest' % n)
+
+		pair = Pair(words[0], words[1])
+		for word in words[2:]:
+			(key, sep, value) = word.partition('=')
+			if not sep or not value or key not in [ 'mode', 'owner', 'service' ]:
+				raise ValueError('line %d: "%s" is not mode=, owner= or service=' %
+						 (n, word))
+			if key == 'mode':
+				try:
+					value = int(value, 8)
+				except ValueError:
+					raise ValueError('line %d: mode must be octal' % n)
+			setattr(pair, key, value)
+		pairs.append(pair)
+	return pairs
+
+
+def stream(pairs, read):
+	"""
+	Generate a tar stream holding the src of each pair as a member
+	named after its index. 'read(path)' yields the bytes of a file.
+	"""
+	now = int(time.time())
+	for (i, pair) in enumerate(pairs):
+		info       = tarfile.TarInfo(str(i))
+		info.size  = os.path.getsize(pair.src)
+		info.mode  = 0o600
+		info.mtime = now
+		yield info.tobuf(format=tarfile.USTAR_FORMAT)
+
+		for chunk in read(pair.src):
+			yield chunk
+		if info.size % BLOCK:
+			yield b'\0' * (BLOCK - info.size % BLOCK)
+	yield b'\0' * (2 * BLOCK)
+
+
+def install_cmd(pairs, digests):
+	"""
+	Shell command run on the host that unpacks the stream, checks
+	each file against 'digests' and moves them into place, making
+	any missing parent directories.
+	"""
+	check = ' '.join([ shlex.quote('%s  %d' % (sha, i))
+			   for (i, sha) in enumerate(digests) ])
+	cmd   = [ 'set -e',
+		  'd=$(mktemp -d /tmp/stack-sync.XXXXXX)',
+		  'trap \'rm -rf "$d"\' EXIT',
+		  'tar -C "$d" -xf -',
+		  'printf "%%s\\n" %s | (cd "$d" && sha256sum -c --status)' % check ]
+
+	for (i, pair) in enumerate(pairs):
+		mode = pair.mode
+		if mode is None:
+			mode = os.stat(pair.src).st_mode & 0o7777
+		tmp = '"$f.stack-sync"'
+		cmd.append('%smkdir -p "$(dirname "$f")"' % target(pair.src, pair.dest))
+		cmd.append('cp "$d/%d" %s' % (i, tmp))
+		cmd.append('chmod %o %s' % (mode, tmp))
+		if pair.owner:
+			cmd.append('chown %s %s' % (shlex.quote(pair.owner), tmp))
+		cmd.append('mv %s "$f"' % tmp)
+	return '; '.join(cmd)
+
+
+def remove_cmd(files, dirs):
+	"""
+	Shell command that removes 'files' on the host, then 'dirs'
+	deepest first if they are empty.
+	"""
+	cmd = []
+	if files:
+		cmd.append('rm -f -- %s' % ' '.join([ shlex.quote(f) for f in files ]))
+	for d in sorted(dirs, key=len, reverse=True):
+		cmd.append('rmdir -- %s 2>/dev/null' % shlex.quote(d))
+	cmd.append('true')
+	return '; '.join(cmd)
+
+
+def verify_cmd(pairs, digests):
+	"""
+	Shell command that checks every dest on the host against
+	'digests'.
+	"""
+	cmd = [ 'set -e' ]
+	for (pair, sha) in zip(pairs, digests):
+		cmd.append('%secho "%s  $f" | sha256sum -c --status' %
+			   (target(pair.src, pair.dest), sha))
+	return '; '.join(cmd)
+
+
+def services(pairs):
+	"""
+	The services the pairs name, each once, in manifest order.
+	"""
+	found = []
+	for pair in pairs:
+		if pair.service and pair.service not in found:
+			found.append(pair.service)
+	return found
@@ -0,0 +1,39 @@
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+import hashlib
+from stack.commands.sync.host.file.remote import locate, ssh
+
+
+def digest(path, blocksize=1024 * 1024):
+	"""
+	sha256 of a local file, as sha256sum prints it.
+	"""
+	h = hashlib.sha256()
+	with open(path, 'rb') as fin:
+		while True:
+			block = fin.read(blocksize)
+			if not block:
+				break
+			h.update(block)
+	return h.hexdigest()
+
+
+def digest_cmd(host, src, dest):
+	"""
+	Shell command that prints the sha256 of the copy of 'src' on
+	'host', or nothing if it isn't there.
+	"""
+	return ssh(host, locate(src, dest) + 'sha256sum "$f" 2>/dev/null')
+
+
+def parse(output):
+	"""
+	Pull the digest out of sha256sum output.
+	"""
+	fields = output.split()
+	if fields:
+		return fields[0]
+	return None
@@ -0,0 +1,205 @@
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+#
+# Resumable transfer of large files in fixed-size chunks.
+#
+# The frontend cuts the file into chunks and hashes each one; the list
+# of hashes is the manifest. On the host every chunk lands in a staging
+# directory next to the file, named after its hash, and only once it
+# checks out, so whatever an interrupted run left there is good. The
+# next run asks the host which chunks it has and sends just the rest.
+# When every chunk of the manifest is there the host concatenates them,
+# checks the whole file and renames it into place.
+#
+# This module only uses the standard library, its source is sent to
+# the hosts and run there as a script for the have and receive steps.
+#
+
+import os
+import sys
+import shutil
+import hashlib
+
+MANIFEST  = b'M'
+CHUNK     = b'C'
+END       = b'E'
+BLOCKSIZE = 64 * 1024
+
+
+def staging(path):
+	return '%s.stack-sync.d' % path
+
+
+def manifest(path, chunksize):
+	"""
+	The sha256 of each 'chunksize' piece of the file at 'path' and
+	of the whole file.
+	"""
+	hashes = []
+	whole  = hashlib.sha256()
+	with open(path, 'rb') as fin:
+		while True:
+			h    = hashlib.sha256()
+			left = chunksize
+			while left:
+				block = fin.read(min(BLOCKSIZE, left))
+				if not block:
+					break
+				h.update(block)
+				whole.update(block)
+				left -= len(block)
+			if left == chunksize:
+				break
+			hashes.append(h.hexdigest())
+	return (hashes, whole.hexdigest())
+
+
+def have(path, out):
+	"""
+	Write the hash of each complete chunk staged for 'path' to
+	'out', one per line.
+	"""
+	try:
+		names = os.listdir(staging(path))
+	except OSError:
+		return
+	for name in names:
+		if not name.endswith('.part'):
+			out.write(('%s\n' % name).encode())
+
+
+def parse_have(output):
+	if isinstance(output, bytes):
+		output = output.decode(errors='replace')
+	return set(output.split())
+
+
+def stream(path, chunksize, hashes, held, read):
+	"""
+	Generate what receive() reads: the manifest, then each chunk
+	the host doesn't hold yet. 'read(path, offset, length)' yields
+	the bytes of one chunk.
+	"""
+	yield MANIFEST + ('%d\n' % len(hashes)).encode()
+	yield ''.join([ '%s\n' % h for h in hashes ]).encode()
+
+	sent = set(held)
+	for (i, h) in enumerate(hashes):
+		if h in sent:
+			continue
+		sent.add(h)
+		offset = i * chunksize
+		length = min(chunksize, os.path.getsize(path) - offset)
+		yield CHUNK + ('%s %d\n' % (h, length)).encode()
+		for block in read(path, offset, length):
+			yield block
+	yield END + b'\n'
+
+
+def store(fin, directory, sha, length):
+	"""
+	Copy 'length' bytes of 'fin' into the staging directory as chunk
+	'sha', keeping it only if it hashes to 'sha'.
+	"""
+	part = os.path.join(directory, '%s.part' % sha)
+	h    = hashlib.sha256()
+	with open(part, 'wb') as fout:
+		while length:
+			block = fin.read(min(BLOCKSIZE, length))
+			if not block:
+				raise IOError('stream ended inside chunk %s' % sha)
+			h.update(block)
+			fout.write(block)
+			length -= len(block)
+		fout.flush()
+		os.fsync(fout.fileno())
+	if h.hexdigest() != sha:
+		os.unlink(part)
+		raise IOError('chunk %s does not match its hash' % sha)
+	os.rename(part, os.path.join(directory, sha))
+
+
+def assemble(path, hashes, sha, mode):
+	"""
+	Concatenate the staged chunks into a temp file next to 'path',
+	check it against 'sha' and rename it over 'path'.
+	"""
+	directory = staging(path)
+	tmp       = '%s.stack-sync' % path
+	whole     = hashlib.sha256()
+	try:
+		with open(tmp, 'wb') as fout:
+			for h in hashes:
+				with open(os.path.join(directory, h), 'rb') as fin:
+					for block in iter(lambda: fin.read(BLOCKSIZE), b''):
+						whole.update(block)
+						fout.write(block)
+			fout.flush()
+			os.fsync(fout.fileno())
+		if whole.hexdigest() != sha:
+			raise IOError('%s does not match its hash' % path)
+		os.chmod(tmp, mode)
+		os.rename(tmp, path)
+	except:
+		if os.path.exists(tmp):
+			os.unlink(tmp)
+		raise
+	shutil.rmtree(directory, ignore_errors=True)
+
+
+def receive(fin, path, sha, mode):
+	"""
+	Read the manifest and chunks from 'fin' into the staging
+	directory, then assemble the file if the stream was complete.
+	"""
+	directory = staging(path)
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+
+	hashes = None
+	while True:
+		line = fin.readline()
+		if not line:
+			raise IOError('stream ended early')
+		(tag, rest) = line[:1], line[1:].decode().split()
+		if tag == MANIFEST:
+			hashes = [ fin.readline().decode().strip()
+				   for i in range(int(rest[0])) ]
+		elif tag == CHUNK:
+			store(fin, directory, rest[0], int(rest[1]))
+		elif tag == END:
+			break
+		else:
+			raise IOError('bad record %r' % tag)
+
+	missing = [ h for h in hashes
+		    if not os.path.exists(os.path.join(directory, h)) ]
+	if missing:
+		raise IOError('%d chunks missing' % len(missing))
+	assemble(path, hashes, sha, mode)
+
+
+def main(args):
+	"""
+	chunk.py have <file>
+	chunk.py receive <file> <sha256> <mode>
+
+	receive reads the manifest and chunks on stdin and replaces
+	the file once all of them are staged.
+	"""
+	(op, path) = args[0], args[1]
+
+	if op == 'have':
+		have(path, sys.stdout.buffer)
+	elif op == 'receive':
+		receive(sys.stdin.buffer, path, args[2], int(args[3], 8))
+	else:
+		return 1
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
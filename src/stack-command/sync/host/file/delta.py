@@ -0,0 +1,304 @@
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+#
+# rsync style delta transfer.
+#
+# The host holding the old copy (the basis) sends a signature: a weak
+# rolling checksum and a strong hash for each block. The frontend
+# slides a window over the new file looking for blocks the host
+# already has and sends a delta made of block references and literal
+# data, which the host patches into a new copy of the file.
+#
+# This module only uses the standard library, its source is sent to
+# the hosts and run there as a script for the signature and patch
+# steps.
+#
+
+import os
+import sys
+import zlib
+import mmap
+import struct
+import hashlib
+import threading
+
+MOD       = 65521
+LITERAL   = b'D'
+COPY      = b'C'
+END       = b'E'
+MAXCHUNK  = 1024 * 1024
+ROLLMAX   = 1024 * 1024
+
+
+def blocksize(size):
+	"""
+	Block size for a file of 'size' bytes, about sqrt(size) like
+	rsync, between 4K and 1M.
+	"""
+	bs = 4096
+	while bs * bs < size and bs < MAXCHUNK:
+		bs *= 2
+	return bs
+
+
+def strong(data):
+	return hashlib.md5(data).hexdigest()
+
+
+def signature(path, bs, out):
+	"""
+	Write one '<weak> <strong> <length>' line per block of the file
+	at 'path' to 'out'. A missing file has an empty signature.
+	"""
+	try:
+		fin = open(path, 'rb')
+	except IOError:
+		return
+	with fin:
+		while True:
+			block = fin.read(bs)
+			if not block:
+				break
+			line = '%d %s %d\n' % (zlib.adler32(block), strong(block), len(block))
+			out.write(line.encode())
+
+
+def parse_signature(text):
+	"""
+	Index a signature by weak checksum. Returns a dict of
+	weak -> [ (strong, length, block number), ... ]
+	"""
+	table = {}
+	for (index, line) in enumerate(text.splitlines()):
+		(weak, digest, length) = line.split()
+		table.setdefault(int(weak), []).append((digest, int(length), index))
+	return table
+
+
+def plan(path, table, bs):
+	"""
+	The delta that turns the basis described by 'table' into the
+	file at 'path', as a list of (COPY, block number) and (LITERAL,
+	start, end) for the ranges of the file sent as they are.
+
+	Matched regions are skipped a block at a time with the checksums
+	done in C, unmatched regions are rolled over byte by byte in
+	Python. That costs a microsecond or two a byte, so after ROLLMAX
+	unmatched bytes in a row we stop rolling and only look for a
+	block at each block boundary from there until something
+	matches. With no basis at all there is nothing to look for and
+	the whole file goes as literal data.
+	"""
+	size = os.path.getsize(path)
+	if not size:
+		return []
+	if not table:
+		return [ (LITERAL, 0, size) ]
+
+	with open(path, 'rb') as fin:
+		data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			return list(_plan(data, size, table, bs))
+		finally:
+			data.close()
+
+
+def render(path, ops):
+	"""
+	Generate the records of the delta planned in 'ops', as a
+	series of byte strings.
+	"""
+	if ops:
+		with open(path, 'rb') as fin:
+			data = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+			try:
+				for op in ops:
+					if op[0] == COPY:
+						yield COPY + struct.pack('>Q', op[1])
+					else:
+						for record in _literal(data, op[1], op[2]):
+							yield record
+			finally:
+				data.close()
+	yield END
+
+
+def delta(path, table, bs):
+	return render(path, plan(path, table, bs))
+
+
+class Plans(object):
+	"""
+	Delta plans for the file at 'path', one per distinct signature,
+	so hosts that hold the same basis share the work. Safe to use
+	from several threads; a host whose plan is being worked out
+	waits for it.
+	"""
+
+	def __init__(self, path, bs):
+		self.path    = path
+		self.bs      = bs
+		self.lock    = threading.Lock()
+		self.entries = {}
+
+	def get(self, text):
+		key = hashlib.sha256(text.encode()).hexdigest()
+		with self.lock:
+			entry = self.entries.setdefault(key, [ threading.Lock(), None ])
+		with entry[0]:
+			if entry[1] is None:
+				entry[1] = plan(self.path, parse_signature(text), self.bs)
+		return entry[1]
+
+
+def _literal(data, start, end):
+	while start < end:
+		stop = min(end, start + MAXCHUNK)
+		yield LITERAL + struct.pack('>I', stop - start) + data[start:stop]
+		start = stop
+
+
+def _match(table, weak, block):
+	candidates = table.get(weak)
+	if not candidates:
+		return None
+	digest = strong(block)
+	for (s, length, index) in candidates:
+		if s == digest and length == len(block):
+			return index
+	return None
+
+
+def _plan(data, size, table, bs):
+	pos     = 0
+	literal = 0
+	fresh   = True
+	rolled  = 0
+
+	while pos < size:
+		end = min(pos + bs, size)
+		if fresh:
+			weak = zlib.adler32(data[pos:end])
+			a    = weak & 0xffff
+			b    = weak >> 16
+
+		index = _match(table, (b << 16) | a, data[pos:end])
+		if index is not None:
+			if literal < pos:
+				yield (LITERAL, literal, pos)
+			yield (COPY, index)
+			pos     = end
+			literal = pos
+			fresh   = True
+			rolled  = 0
+			continue
+
+		#
+		# a short tail only ever matches the basis' own tail,
+		# which we checked above
+		#
+		if end == size:
+			break
+
+		if rolled >= ROLLMAX:
+			pos   = end
+			fresh = True
+			continue
+
+		#
+		# roll the window one byte, keeping adler32's a and b
+		# the same as zlib would compute them
+		#
+		out  = data[pos]
+		new  = data[end]
+		a    = (a - out + new) % MOD
+		b    = (b - bs * out + a - 1) % MOD
+		pos += 1
+		fresh  = False
+		rolled += 1
+
+	if literal < size:
+		yield (LITERAL, literal, size)
+
+
+def patch(basis, fin, path, bs):
+	"""
+	Apply the delta read from 'fin' to 'basis', writing the result
+	to 'path'. A delta that stops short of its END record is an
+	error, so a dropped connection never yields a truncated file.
+	"""
+	try:
+		old = open(basis, 'rb')
+	except IOError:
+		old = None
+
+	with open(path, 'wb') as out:
+		while True:
+			op = fin.read(1)
+			if op == END:
+				break
+			elif op == COPY:
+				(index, ) = struct.unpack('>Q', fin.read(8))
+				old.seek(index * bs)
+				out.write(old.read(bs))
+			elif op == LITERAL:
+				(length, ) = struct.unpack('>I', fin.read(4))
+				while length:
+					chunk = fin.read(min(length, MAXCHUNK))
+					if not chunk:
+						raise IOError('truncated delta')
+					out.write(chunk)
+					length -= len(chunk)
+			elif not op:
+				raise IOError('truncated delta')
+			else:
+				raise IOError('bad delta record %r' % op)
+
+	if old:
+		old.close()
+
+
+def digest(path):
+	h = hashlib.sha256()
+	with open(path, 'rb') as fin:
+		for block in iter(lambda: fin.read(MAXCHUNK), b''):
+			h.update(block)
+	return h.hexdigest()
+
+
+def main(args):
+	"""
+	delta.py signature <file> <blocksize>
+	delta.py patch <file> <blocksize> [sha256]
+
+	patch reads the delta on stdin and replaces the file with the
+	result, keeping its mode, once the result matches the sha256.
+	"""
+	(op, path, bs) = args[0], args[1], int(args[2])
+	sha = args[3] if len(args) > 3 else None
+
+	if op == 'signature':
+		signature(path, bs, sys.stdout.buffer)
+	elif op == 'patch':
+		tmp = '%s.stack-sync' % path
+		try:
+			patch(path, sys.stdin.buffer, tmp, bs)
+			if sha and digest(tmp) != sha:
+				raise IOError('patched %s does not match its hash' % path)
+		except:
+			if os.path.exists(tmp):
+				os.unlink(tmp)
+			raise
+		if os.path.exists(path):
+			os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+		os.rename(tmp, path)
+	else:
+		return 1
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,103 @@
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+#
+# Throughput seen by earlier syncs, kept on the frontend so a dry run
+# can estimate how long a sync would take. For each host we keep the
+# last few transfer rates and ssh connect times, and for each run the
+# rate the frontend managed across all of its hosts.
+#
+
+import os
+import json
+import time
+import statistics
+
+PATH = '/var/cache/stack/sync-host-file.json'
+KEEP = 10
+
+
+def load(path=PATH):
+	try:
+		with open(path) as fin:
+			return json.load(fin)
+	except (IOError, ValueError):
+		return { 'hosts': {}, 'runs': [] }
+
+
+def save(history, path=PATH):
+	"""
+	Write the history through a temp file so a reader never sees
+	half of it. Best effort, a sync doesn't fail over its history.
+	"""
+	tmp = '%s.%d' % (path, os.getpid())
+	try:
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with open(tmp, 'w') as fout:
+			json.dump(history, fout)
+		os.rename(tmp, path)
+	except (IOError, OSError):
+		if os.path.exists(tmp):
+			os.unlink(tmp)
+
+
+def record(samples, total, wall, path=PATH):
+	"""
+	Add a run: 'samples' maps each host that got the file to its
+	(bytes/sec, connect seconds), 'total' is the bytes sent to all
+	of them in 'wall' seconds.
+	"""
+	if not samples or not wall:
+		return
+	history = load(path)
+	for (host, (rate, connect)) in samples.items():
+		entry = history['hosts'].setdefault(host, { 'rate': [], 'connect': [] })
+		entry['rate']    = (entry['rate'] + [ rate ])[-KEEP:]
+		entry['connect'] = (entry['connect'] + [ connect ])[-KEEP:]
+	history['runs'] = (history['runs'] +
+			   [ { 'time': int(time.time()), 'rate': total / wall,
+			       'hosts': len(samples) } ])[-KEEP:]
+	save(history, path)
+
+
+def estimate(history, hosts, size, parallel):
+	"""
+	Seconds to send 'size' bytes to each of 'hosts' with 'parallel'
+	transfers in flight, and the seconds for each host, from the
+	median rates in 'history'. A host we have never seen gets the
+	median of all hosts. None where there is nothing to go on.
+	"""
+	rates    = []
+	connects = []
+	for entry in history['hosts'].values():
+		rates.extend(entry['rate'])
+		connects.extend(entry['connect'])
+	if not hosts:
+		return (0.0, {})
+	if not rates:
+		return (None, {})
+
+	default = (statistics.median(rates), statistics.median(connects))
+	each    = {}
+	for host in hosts:
+		entry = history['hosts'].get(host)
+		(rate, connect) = default
+		if entry:
+			(rate, connect) = (statistics.median(entry['rate']),
+					   statistics.median(entry['connect']))
+		each[host] = connect + size / max(rate, 1.0)
+
+	#
+	# the slowest host, the hosts spread over the transfer slots,
+	# or the most the frontend has pushed in one run, whichever
+	# takes longest
+	#
+	total = max(max(each.values()),
+		    sum(each.values()) / min(parallel, len(hosts)))
+	if history['runs']:
+		best  = max([ run['rate'] for run in history['runs'] ])
+		total = max(total, size * len(hosts) / max(best, 1.0))
+	return (total, each)
@@ -0,0 +1,88 @@
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+#
+# Pull mode: the file is published on the frontend's web server under
+# a name made from its digest and every host fetches it, in a few
+# parallel Range requests, instead of the frontend pushing N copies.
+#
+
+import os
+import shlex
+import shutil
+
+DOCROOT = '/var/www/html'
+PREFIX  = 'stack-sync'
+
+
+def publish(src, sha):
+	"""
+	Make 'src' available under DOCROOT/PREFIX/<sha>. Returns the
+	path relative to DOCROOT.
+
+	Whatever is published can be read by anyone on the private
+	network for as long as the sync runs. A src that is already
+	world readable is hard linked; anything else is copied and
+	only the copy is made readable, a link shares the inode and
+	a chmod of it would change src itself.
+	"""
+	directory = os.path.join(DOCROOT, PREFIX)
+	if not os.path.isdir(directory):
+		os.makedirs(directory, 0o755)
+
+	path = os.path.join(directory, sha)
+	if not os.path.exists(path):
+		linked = False
+		if os.stat(src).st_mode & 0o004:
+			try:
+				os.link(src, path)
+				linked = True
+			except OSError:
+				pass
+		if not linked:
+			shutil.copyfile(src, path)
+			os.chmod(path, 0o644)
+
+	return '%s/%s' % (PREFIX, sha)
+
+
+def unpublish(sha):
+	try:
+		os.unlink(os.path.join(DOCROOT, PREFIX, sha))
+	except OSError:
+		pass
+
+
+def fetch_cmd(url, size, sha, mode, segments=4, rate=None):
+	"""
+	Shell command run on a host (after $f is set) that fetches 'url'
+	in up to 'segments' parallel Range requests, checks the result
+	against 'sha' and only then moves it over $f. 'rate' caps the
+	download in bytes/sec.
+	"""
+	segments = max(1, min(segments, size // (1024 * 1024) or 1))
+	step     = size // segments + 1
+	url      = shlex.quote(url)
+	limit    = ''
+	if rate:
+		limit = '--limit-rate %d ' % max(1024, rate // segments)
+
+	tmp   = '"$f.stack-sync"'
+	fetch = [ 'rm -f %s; ' % tmp ]
+	parts = []
+	for i in range(segments):
+		start = i * step
+		end   = min(size, start + step) - 1
+		part  = '"$f.stack-sync.%d"' % i
+		span  = '-r %d-%d ' % (start, end) if size else ''
+		fetch.append('curl -sf %s%s-o %s %s & p%d=$!; ' % (limit, span, part, url, i))
+		parts.append(part)
+
+	wait = ' && '.join([ 'wait $p%d' % i for i in range(segments) ])
+
+	return ''.join(fetch) + \
+		'if %s; then cat %s > %s; fi; rm -f %s; ' % (wait, ' '.join(parts), tmp, ' '.join(parts)) + \
+		'if echo "%s  $f.stack-sync" | sha256sum -c --status; ' % sha + \
+		'then chmod %o %s && mv %s "$f"; else rm -f %s; exit 1; fi' % (mode, tmp, tmp, tmp)
@@ -0,0 +1,89 @@
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+import shlex
+from stack.commands.sync.host.file.remote import locate, target, upload, ssh, scp
+
+
+def plan_tree(hosts, fanout=1):
+	"""
+	Split hosts into relay rounds.
+
+	In every round each host that already holds the file (the
+	frontend included) sends it on to up to 'fanout' new hosts, so
+	the number of holders grows by a factor of fanout + 1 per round
+	and N hosts are reached in log(N) rounds.
+
+	Returns a list of rounds, each a list of (source, target) pairs.
+	A source of None is the frontend.
+	"""
+	rounds  = []
+	holders = [ None ]
+	pending = list(hosts)
+
+	while pending:
+		pairs = []
+		for source in holders:
+			for i in range(fanout):
+				if not pending:
+					break
+				pairs.append((source, pending.pop(0)))
+		holders.extend([ target for (source, target) in pairs ])
+		rounds.append(pairs)
+
+	return rounds
+
+
+def plan_staged(groups, fanout=1):
+	"""
+	Plan a copy that crosses the spine once per subnet.
+
+	'groups' is a list of host lists, one per subnet. The first
+	round sends the file from the frontend to the first host of each
+	group, its leader; after that each leader relays it within its
+	own group as plan_tree() would, all groups in step.
+
+	Returns rounds in the same form as plan_tree().
+	"""
+	groups = [ members for members in groups if members ]
+	rounds = [ [ (None, members[0]) for members in groups ] ]
+
+	for members in groups:
+		leader = members[0]
+		for (i, pairs) in enumerate(plan_tree(members[1:], fanout)):
+			if len(rounds) < i + 2:
+				rounds.append([])
+			rounds[i + 1].extend([ (source or leader, target)
+					       for (source, target) in pairs ])
+
+	return rounds
+
+
+def relay_cmd(source, host, src, dest, recurse=False, mode=None, sha=None):
+	"""
+	Shell command that copies 'src' to 'host:dest'.
+
+	With no source the copy is a plain scp from the frontend.
+	Otherwise we ssh to the source host (forwarding our agent so it
+	can reach the target) and have it scp the copy it already holds,
+	or, for a file with its 'mode' and 'sha', stream it to the
+	target's temp file to be checked and renamed into place.
+	"""
+	flags = '-r ' if recurse else ''
+
+	if not source:
+		return scp(src, host, dest, flags)
+
+	if sha and not recurse:
+		install = target(src, dest) + upload(mode, sha)
+		remote  = locate(src, dest) + \
+			  'ssh -o StrictHostKeyChecking=no %s %s < "$f"' % \
+			  (host, shlex.quote(install))
+	else:
+		remote  = locate(src, dest) + \
+			  'scp -o StrictHostKeyChecking=no %s"$f" %s:%s' % \
+			  (flags, host, shlex.quote(dest))
+
+	return ssh(source, remote, '-A ')
@@ -0,0 +1,130 @@
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+import os
+import shlex
+import inspect
+
+PYTHON = '/opt/stack/bin/python3'
+
+#
+# Every ssh and scp from the frontend goes through one multiplexed
+# connection per host, so a host pays for a single key exchange no
+# matter how many steps its sync takes. 'persist' is how many idle
+# seconds the master connection is kept up after the last client
+# exits; 0 keeps it only until close() is called.
+#
+persist = 60
+
+CONTROLPATH = '~/.ssh/stack-sync-%C'
+
+
+def options():
+	return '-o ControlMaster=auto -o ControlPath=%s -o ControlPersist=%s ' % \
+		(CONTROLPATH, persist if persist else 'yes')
+
+
+def locate(src, dest):
+	"""
+	Shell snippet that sets $f to the path 'src' ends up at on a
+	host once it is copied to 'dest'. Like scp, if dest is a
+	directory the file lands underneath it.
+	"""
+	path   = shlex.quote(dest)
+	nested = shlex.quote(os.path.join(dest, os.path.basename(src.rstrip('/'))))
+	return 'f=%s; [ -d "$f" ] && [ -e %s ] && f=%s; ' % (path, nested, nested)
+
+
+def target(src, dest):
+	"""
+	Shell snippet that sets $f to the path a copy of file 'src' to
+	'dest' is written to, whether or not it is there yet.
+	"""
+	path   = shlex.quote(dest)
+	nested = shlex.quote(os.path.join(dest, os.path.basename(src)))
+	return 'f=%s; [ -d "$f" ] && f=%s; ' % (path, nested)
+
+
+def upload(mode, sha=None):
+	"""
+	Shell command run on a host (after $f is set) that writes its
+	stdin to a temp file next to $f and moves it into place once
+	the stream is complete and, given 'sha', matches it. Whatever
+	reads $f sees the old file or the new one, never part of it.
+	"""
+	tmp   = '"$f.stack-sync"'
+	check = ''
+	if sha:
+		check = 'echo "%s  $f.stack-sync" | sha256sum -c --status && ' % sha
+	return 'cat > %s && %schmod %o %s && mv %s "$f" || { rm -f %s; exit 1; }' % \
+		(tmp, check, mode, tmp, tmp, tmp)
+
+
+#
+# With rollback the previous $f is kept as a hard link while the rest
+# of the cluster is synced (or a marker if there wasn't one), so it
+# can be put back or let go of once we know how the sync went.
+#
+
+def backup():
+	return 'rm -f "$f.stack-sync.prev" "$f.stack-sync.none"; ' \
+	       'if [ -e "$f" ]; then ln -f "$f" "$f.stack-sync.prev"; ' \
+	       'else : > "$f.stack-sync.none"; fi'
+
+
+def restore():
+	return 'if [ -e "$f.stack-sync.prev" ]; then mv -f "$f.stack-sync.prev" "$f"; ' \
+	       'elif [ -e "$f.stack-sync.none" ]; then rm -f "$f" "$f.stack-sync.none"; fi'
+
+
+def discard():
+	return 'rm -f "$f.stack-sync.prev" "$f.stack-sync.none"'
+
+
+def read(path, offset=0, length=None, blocksize=64 * 1024):
+	"""
+	Generate the bytes of a local file, or 'length' of them from
+	'offset', as byte strings.
+	"""
+	with open(path, 'rb') as fin:
+		fin.seek(offset)
+		while length is None or length > 0:
+			n = blocksize if length is None else min(blocksize, length)
+			chunk = fin.read(n)
+			if not chunk:
+				break
+			if length is not None:
+				length -= len(chunk)
+			yield chunk
+
+
+def script(module, args):
+	"""
+	Shell command that runs the source of 'module' on a host with
+	the python there. The module must only use the standard library.
+	"""
+	return '%s -c %s %s' % (PYTHON, shlex.quote(inspect.getsource(module)), args)
+
+
+def ssh(host, command, flags=''):
+	"""
+	Shell command that runs 'command' on 'host'.
+	"""
+	return 'ssh %s%s%s %s' % (options(), flags, host, shlex.quote(command))
+
+
+def scp(src, host, dest, flags=''):
+	"""
+	Shell command that copies 'src' to 'dest' on 'host'.
+	"""
+	return 'scp %s%s%s %s:%s' % (options(), flags, shlex.quote(src), host,
+				    shlex.quote(dest))
+
+
+def close(host):
+	"""
+	Shell command that shuts down the master connection to 'host'.
+	"""
+	return 'ssh -o ControlPath=%s -O exit %s' % (CONTROLPATH, host)
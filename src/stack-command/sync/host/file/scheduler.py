@@ -0,0 +1,641 @@
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+import os
+import sys
+import time
+import queue
+import signal
+import asyncio
+import statistics
+import collections
+import threading
+import subprocess
+
+
+class Step(object):
+	"""
+	One command run on the frontend on behalf of a host, e.g. an
+	scp to it or an ssh into it. A string is run through the shell,
+	a list is exec'ed directly.
+
+	'input' is an optional callable taking the task and returning
+	an iterable of byte strings to feed the command's stdin. It is
+	called when the step starts, so it can use the output of the
+	steps before it.
+
+	'gate' is an optional Gate the step has to pass before it runs.
+	"""
+
+	def __init__(self, cmd, name=None, input=None, gate=None):
+		self.cmd   = cmd
+		self.name  = name
+		self.input = input
+		self.gate  = gate
+
+
+class Gate(object):
+	"""
+	Limits how many tasks run a gated step at once ('inflight') and
+	optionally lets them through in waves of 'batch': once a wave is
+	full the next one only opens after every step of the wave is
+	done.
+	"""
+
+	def __init__(self, batch=None, inflight=None):
+		self.batch    = batch
+		self.inflight = inflight
+		self.running  = 0
+		self.admitted = 0
+		self.cond     = threading.Condition()
+
+	def ready(self):
+		if self.batch and self.admitted >= self.batch:
+			if self.running:
+				return False
+			self.admitted = 0
+		if self.inflight and self.running >= self.inflight:
+			return False
+		return True
+
+	def acquire(self, timeout=None):
+		"""
+		Wait for a slot, False if 'timeout' seconds pass first.
+		"""
+		with self.cond:
+			if not self.cond.wait_for(self.ready, timeout):
+				return False
+			self.admitted += 1
+			self.running  += 1
+			return True
+
+	def release(self):
+		with self.cond:
+			self.running -= 1
+			self.cond.notify_all()
+
+
+class Task(object):
+	"""
+	The work for a single host: its steps run in order and the
+	first one that fails ends the task.
+
+	'size' is the bytes the steps deliver to the host on top of
+	anything fed through stdin, and 'source' the host they come
+	from when it isn't the frontend. 'times' holds the seconds
+	spent in each step by name and 'step' is the last one run.
+	'retried' lists why each earlier attempt was given up on and
+	'straggler' is set if its transfer stalled or fell far behind
+	the others. 'retries' overrides the scheduler's for this task;
+	probes, where a non-zero exit is an answer, use 0.
+	"""
+
+	def __init__(self, host, steps, size=0, source=None, retries=None):
+		self.host    = host
+		self.steps   = steps
+		self.size    = size
+		self.source  = source
+		self.retries = retries
+		self.sent    = 0
+		self.times   = {}
+		self.feeding = 0.0
+		self.mark    = (0.0, 0)
+		self.progress  = 0.0
+		self.step    = None
+		self.status  = 'queued'
+		self.rc      = None
+		self.output  = ''
+		self.error   = ''
+		self.queued  = None
+		self.started = None
+		self.ended   = None
+		self.retried   = []
+		self.straggler = False
+		self.notbefore = 0
+
+	def reset(self):
+		"""
+		Back to queued for another attempt.
+		"""
+		self.sent    = 0
+		self.times   = {}
+		self.feeding = 0.0
+		self.step    = None
+		self.status  = 'queued'
+		self.rc      = None
+		self.output  = ''
+		self.error   = ''
+		self.started = None
+		self.ended   = None
+
+	def begin(self):
+		"""
+		A step that feeds the host starts: its throughput is
+		measured from here.
+		"""
+		now           = time.time()
+		self.mark     = (now, self.sent)
+		self.progress = now
+
+	def fed(self, count):
+		self.sent    += count
+		self.progress = time.time()
+
+	def throughput(self):
+		"""
+		Bytes/sec fed to the host by the current step.
+		"""
+		(start, sent) = self.mark
+		elapsed = time.time() - start
+		if elapsed <= 0:
+			return 0.0
+		return (self.sent - sent) / elapsed
+
+	def wait(self):
+		if self.started is None:
+			return 0.0
+		return self.started - self.queued
+
+	def elapsed(self):
+		if self.ended is None:
+			return 0.0
+		return self.ended - self.started
+
+	def bytes(self):
+		return self.size + self.sent
+
+
+class Scheduler(object):
+	"""
+	Runs tasks with at most 'parallel' of them in flight. Hosts
+	wait in a queue and the next one starts as soon as a running
+	task finishes.
+
+	'deadline' is the wall-clock time (as from time.time()) by
+	which everything has to be done and 'timeout' caps the time
+	spent on a single host. A task still running when either
+	passes is killed ('cancelled' or 'timeout'); tasks still queued
+	at the deadline are never started ('cancelled').
+
+	With a 'throttle' (see throttle.py) everything fed to the steps'
+	stdin goes through its bandwidth caps, and a queued task only
+	starts once the throttle admits it.
+
+	A step feeding the host through stdin is flagged as a straggler
+	if nothing has gone through for STALL seconds or, once a few
+	tasks are done, its throughput falls below 1/'straggler' of
+	their median. Hosts get different bytes under delta, chunks or
+	checksum, so it is the rate that counts, not the time taken.
+	With 'kill' a straggler is also killed so it can be retried.
+	A task that failed, timed out or was killed for straggling goes
+	back in the queue up to 'retries' times (the task's own, if it
+	has one), waiting 'backoff' seconds before the first retry and
+	twice as long before each one after that. Tasks that failed in
+	a gated step (a service restart) are not retried.
+	"""
+
+	POLL    = 0.05
+	CHECK   = 1.0
+	SAMPLES = 3
+	STALL   = 30.0
+
+	def __init__(self, parallel=64, deadline=None, timeout=None, throttle=None,
+		     retries=0, backoff=1.0, straggler=None, kill=False):
+		self.parallel  = max(1, parallel)
+		self.deadline  = deadline
+		self.timeout   = timeout
+		self.throttle  = throttle
+		self.retries   = retries
+		self.backoff   = backoff
+		self.straggler = straggler
+		self.kill      = kill
+		self.running   = 0
+		self.rates     = []
+		self.lock      = threading.Lock()
+
+	def admit(self):
+		"""
+		Counts a task into 'running' if the throttle lets it start.
+		"""
+		with self.lock:
+			if self.throttle and not self.throttle.admit(self.running):
+				return False
+			self.running += 1
+			return True
+
+	def release(self):
+		with self.lock:
+			self.running -= 1
+
+	def chunks(self, task, step):
+		chunks = step.input(task)
+		if self.throttle:
+			chunks = self.throttle.wrap(chunks)
+		return chunks
+
+	def limit(self, task):
+		if task.retries is None:
+			return self.retries
+		return task.retries
+
+	def straggling(self, task):
+		"""
+		Flags the task if the step feeding it has stalled or its
+		throughput is far below the median of the tasks done so
+		far. True if it should be killed to retry it.
+		"""
+		if not self.straggler:
+			return False
+		now  = time.time()
+		slow = now - task.progress >= self.STALL
+		if not slow and len(self.rates) >= self.SAMPLES and \
+				now - task.mark[0] >= self.straggler * self.CHECK:
+			with self.lock:
+				median = statistics.median(self.rates)
+			slow = task.throughput() < median / self.straggler
+		if not slow:
+			return False
+		task.straggler = True
+		return self.kill and len(task.retried) < self.limit(task)
+
+	def retry(self, task):
+		"""
+		Requeue the task after its backoff if it is worth another
+		attempt. True if it was requeued.
+		"""
+		if task.status == 'ok':
+			if task.feeding and task.sent:
+				with self.lock:
+					self.rates.append(task.sent / task.feeding)
+			return False
+		if task.status not in [ 'failed', 'timeout', 'straggler' ]:
+			return False
+		if len(task.retried) >= self.limit(task):
+			return False
+		if [ step for step in task.steps if step.name == task.step and step.gate ]:
+			return False
+
+		delay = self.backoff * 2 ** len(task.retried)
+		if self.deadline is not None and time.time() + delay >= self.deadline:
+			return False
+
+		reason = task.status
+		if task.status == 'failed':
+			reason = 'rc %s' % task.rc
+		task.retried.append('%s in %s' % (reason, task.step))
+		task.reset()
+		task.notbefore = time.time() + delay
+		return True
+
+	def expired(self):
+		return self.deadline is not None and time.time() >= self.deadline
+
+	def remaining(self, task):
+		"""
+		Seconds the task may still run, None if unbounded.
+		"""
+		now    = time.time()
+		limits = []
+		if self.deadline is not None:
+			limits.append(self.deadline - now)
+		if self.timeout:
+			limits.append(task.started + self.timeout - now)
+		if not limits:
+			return None
+		return max(0, min(limits))
+
+	def run(self, tasks):
+		work = queue.Queue()
+		now  = time.time()
+		self.rates = []
+		for task in tasks:
+			task.queued = now
+			work.put(task)
+
+		workers = []
+		for i in range(min(self.parallel, len(tasks))):
+			worker = threading.Thread(target=self.worker, args=(work, ))
+			worker.daemon = True
+			worker.start()
+			workers.append(worker)
+
+		for worker in workers:
+			worker.join()
+
+		return tasks
+
+	def worker(self, work):
+		while True:
+			try:
+				task = work.get_nowait()
+			except queue.Empty:
+				return
+			if task.notbefore > time.time():
+				work.put(task)
+				time.sleep(self.POLL)
+				continue
+			while not self.admit():
+				time.sleep(self.POLL)
+			try:
+				self.execute(task)
+			finally:
+				self.release()
+			if self.retry(task):
+				work.put(task)
+
+	def execute(self, task):
+		if self.expired():
+			task.status = 'cancelled'
+			return
+		self.steps(task)
+
+	def steps(self, task):
+		task.started = time.time()
+		task.status  = 'running'
+
+		for step in task.steps:
+			task.step = step.name
+			if not step.gate:
+				self.spawn(task, step)
+			elif step.gate.acquire(self.remaining(task)):
+				try:
+					self.spawn(task, step)
+				finally:
+					step.gate.release()
+			else:
+				task.rc     = -1
+				task.status = 'cancelled' if self.expired() else 'timeout'
+			if task.rc:
+				break
+
+		task.ended = time.time()
+		if task.status == 'running':
+			task.status = 'failed' if task.rc else 'ok'
+
+	def spawn(self, task, step):
+		#
+		# each step gets its own process group so a kill
+		# also takes out whatever the shell started
+		#
+		proc = subprocess.Popen(step.cmd,
+					shell=isinstance(step.cmd, str),
+					stdin=subprocess.PIPE if step.input else subprocess.DEVNULL,
+					stdout=subprocess.PIPE,
+					stderr=subprocess.PIPE,
+					start_new_session=True)
+
+		start   = time.time()
+		output  = []
+		error   = []
+		if step.input:
+			task.begin()
+		threads = [ threading.Thread(target=self.drain, args=(proc.stdout, output)),
+			    threading.Thread(target=self.drain, args=(proc.stderr, error)) ]
+		if step.input:
+			threads.append(threading.Thread(target=self.feed,
+							args=(task, step, proc)))
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+
+		while True:
+			remaining = self.remaining(task)
+			try:
+				proc.wait(timeout=self.CHECK if remaining is None
+					  else min(remaining, self.CHECK))
+				break
+			except subprocess.TimeoutExpired:
+				pass
+			if remaining is not None and remaining <= self.CHECK:
+				os.killpg(proc.pid, signal.SIGKILL)
+				proc.wait()
+				task.status = 'cancelled' if self.expired() else 'timeout'
+				break
+			if step.input and self.straggling(task):
+				os.killpg(proc.pid, signal.SIGKILL)
+				proc.wait()
+				task.status = 'straggler'
+				break
+
+		for thread in threads:
+			thread.join()
+
+		task.times[step.name] = task.times.get(step.name, 0.0) + time.time() - start
+		if step.input:
+			task.feeding += time.time() - start
+		task.rc      = proc.returncode
+		task.output += b''.join(output).decode(errors='replace')
+		task.error  += b''.join(error).decode(errors='replace')
+
+	def drain(self, pipe, chunks):
+		with pipe:
+			for chunk in iter(lambda: pipe.read(65536), b''):
+				chunks.append(chunk)
+
+	def feed(self, task, step, proc):
+		try:
+			with proc.stdin:
+				for chunk in self.chunks(task, step):
+					proc.stdin.write(chunk)
+					task.fed(len(chunk))
+		except BrokenPipeError:
+			pass
+		except Exception as e:
+			#
+			# the command can't be allowed to finish on
+			# partial input
+			#
+			task.error += '%s\n' % e
+			os.killpg(proc.pid, signal.SIGKILL)
+
+
+class AsyncScheduler(Scheduler):
+	"""
+	Same contract as Scheduler, but every child process is driven
+	from one asyncio event loop instead of a thread (plus one for
+	each of its pipes) per running task. Worth it once 'parallel'
+	runs into the thousands.
+	"""
+
+	def run(self, tasks):
+		now = time.time()
+		self.rates = []
+		for task in tasks:
+			task.queued = now
+
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+
+		#
+		# from 3.8 to 3.11 the default child watcher starts a thread
+		# per child to wait on it, which is what we're avoiding.
+		# Watch children through pidfds instead where we can, 3.12
+		# does this on its own.
+		#
+		if sys.version_info < (3, 12) and hasattr(asyncio, 'PidfdChildWatcher'):
+			watcher = asyncio.PidfdChildWatcher()
+			watcher.attach_loop(loop)
+			asyncio.set_child_watcher(watcher)
+
+		try:
+			loop.run_until_complete(self.main(loop, tasks))
+		finally:
+			loop.close()
+			asyncio.set_event_loop(None)
+
+		return tasks
+
+	async def main(self, loop, tasks):
+		work    = collections.deque(tasks)
+		await asyncio.gather(*[ self.worker(loop, work)
+					for i in range(min(self.parallel, len(tasks))) ])
+
+	async def worker(self, loop, work):
+		while work:
+			task = work.popleft()
+			if task.notbefore > time.time():
+				work.append(task)
+				await asyncio.sleep(self.POLL)
+				continue
+			while not self.admit():
+				await asyncio.sleep(self.POLL)
+			try:
+				await self.execute(loop, task)
+			finally:
+				self.release()
+			if self.retry(task):
+				work.append(task)
+
+	async def execute(self, loop, task):
+		if self.expired():
+			task.status = 'cancelled'
+			return
+		await self.steps(loop, task)
+
+	async def steps(self, loop, task):
+		task.started = time.time()
+		task.status  = 'running'
+
+		for step in task.steps:
+			task.step = step.name
+			if not step.gate:
+				await self.spawn(loop, task, step)
+			elif await self.acquire(task, step.gate):
+				try:
+					await self.spawn(loop, task, step)
+				finally:
+					step.gate.release()
+			else:
+				task.rc     = -1
+				task.status = 'cancelled' if self.expired() else 'timeout'
+			if task.rc:
+				break
+
+		task.ended = time.time()
+		if task.status == 'running':
+			task.status = 'failed' if task.rc else 'ok'
+
+	async def acquire(self, task, gate):
+		"""
+		Gates block, so poll them instead of holding up the loop.
+		"""
+		while not gate.acquire(0):
+			remaining = self.remaining(task)
+			if remaining is not None and remaining <= 0:
+				return False
+			await asyncio.sleep(self.POLL)
+		return True
+
+	async def spawn(self, loop, task, step):
+		stdin = subprocess.PIPE if step.input else subprocess.DEVNULL
+		if isinstance(step.cmd, str):
+			create = asyncio.create_subprocess_shell(step.cmd, stdin=stdin,
+					stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+					start_new_session=True)
+		else:
+			create = asyncio.create_subprocess_exec(*step.cmd, stdin=stdin,
+					stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+					start_new_session=True)
+
+		start = time.time()
+		proc  = await create
+		if step.input:
+			task.begin()
+		io    = [ proc.stdout.read(), proc.stderr.read() ]
+		if step.input:
+			io.append(self.feed(loop, task, step, proc))
+		io = asyncio.gather(*io)
+
+		done = asyncio.ensure_future(proc.wait())
+		while True:
+			remaining = self.remaining(task)
+			await asyncio.wait([ done ], timeout=self.CHECK if remaining is None
+					   else min(remaining, self.CHECK))
+			if done.done():
+				break
+			if remaining is not None and remaining <= self.CHECK:
+				os.killpg(proc.pid, signal.SIGKILL)
+				await done
+				task.status = 'cancelled' if self.expired() else 'timeout'
+				break
+			if step.input and self.straggling(task):
+				os.killpg(proc.pid, signal.SIGKILL)
+				await done
+				task.status = 'straggler'
+				break
+
+		(output, error) = (await io)[:2]
+
+		task.times[step.name] = task.times.get(step.name, 0.0) + time.time() - start
+		if step.input:
+			task.feeding += time.time() - start
+		task.rc      = proc.returncode
+		task.output += output.decode(errors='replace')
+		task.error  += error.decode(errors='replace')
+
+	async def feed(self, loop, task, step, proc):
+		#
+		# the input generators may block (reading a local tar,
+		# computing a delta) so step them in the executor
+		#
+		chunks = iter(self.chunks(task, step))
+		try:
+			while True:
+				chunk = await loop.run_in_executor(None, next, chunks, None)
+				if chunk is None:
+					break
+				proc.stdin.write(chunk)
+				await proc.stdin.drain()
+				task.fed(len(chunk))
+		except (BrokenPipeError, ConnectionResetError):
+			pass
+		except Exception as e:
+			task.error += '%s\n' % e
+			os.killpg(proc.pid, signal.SIGKILL)
+		finally:
+			proc.stdin.close()
+
+
+def stats(tasks):
+	"""
+	Summarize a run as a list of (name, value) pairs. Times are
+	in seconds.
+	"""
+	started = [ task for task in tasks if task.started is not None ]
+	waits   = [ task.wait() for task in started ] or [ 0.0 ]
+	runs    = [ task.elapsed() for task in started ] or [ 0.0 ]
+
+	return [
+		('hosts',        len(tasks)),
+		('failed',       len([ t for t in tasks if t.status == 'failed' ])),
+		('timeout',      len([ t for t in tasks if t.status == 'timeout' ])),
+		('cancelled',    len([ t for t in tasks if t.status == 'cancelled' ])),
+		('retried',      len([ t for t in tasks if t.retried ])),
+		('stragglers',   len([ t for t in tasks if t.straggler ])),
+		('wait-avg',     round(sum(waits) / len(waits), 3)),
+		('wait-max',     round(max(waits), 3)),
+		('transfer-avg', round(sum(runs) / len(runs), 3)),
+		('transfer-max', round(max(runs), 3)),
+	]
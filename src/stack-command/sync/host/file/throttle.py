@@ -0,0 +1,103 @@
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+import time
+import threading
+import collections
+
+
+class TokenBucket(object):
+	"""
+	Allows 'rate' bytes per second on average with bursts of up to
+	'burst' bytes. consume() may take the bucket into debt and then
+	sleeps until the debt is paid, so chunks larger than the burst
+	still go through, just later.
+	"""
+
+	def __init__(self, rate, burst=None):
+		self.rate   = float(rate)
+		self.burst  = burst or max(64 * 1024, self.rate / 4)
+		self.tokens = self.burst
+		self.stamp  = time.time()
+		self.lock   = threading.Lock()
+
+	def consume(self, n):
+		with self.lock:
+			now         = time.time()
+			self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+			self.stamp  = now
+			self.tokens -= n
+			wait        = -self.tokens / self.rate if self.tokens < 0 else 0
+		if wait:
+			time.sleep(wait)
+
+
+class Throttle(object):
+	"""
+	Bandwidth caps for what the frontend sends: 'total' bytes/sec
+	across all hosts and 'host' bytes/sec to any one of them, either
+	may be None.
+
+	wrap() runs a step's input through the buckets. admit() tells
+	the scheduler whether starting another transfer is worth it:
+	while the measured total is short of the cap (the hosts we're
+	sending to are slow) it lets in up to as many new transfers per
+	window as were already running, and once the cap is reached it
+	holds the queue, since more transfers would only split the same
+	bandwidth.
+	"""
+
+	WINDOW = 0.5
+
+	def __init__(self, total=None, host=None):
+		self.total    = TokenBucket(total) if total else None
+		self.host     = host
+		self.sent     = collections.deque()
+		self.admitted = 0
+		self.opened   = time.time()
+		self.lock     = threading.Lock()
+
+	def wrap(self, chunks):
+		bucket = TokenBucket(self.host) if self.host else None
+		for chunk in chunks:
+			if bucket:
+				bucket.consume(len(chunk))
+			if self.total:
+				self.total.consume(len(chunk))
+			with self.lock:
+				self.sent.append((time.time(), len(chunk)))
+			yield chunk
+
+	def recent(self):
+		"""
+		Bytes/sec sent over the last two windows.
+		"""
+		with self.lock:
+			horizon = time.time() - 2 * self.WINDOW
+			while self.sent and self.sent[0][0] < horizon:
+				self.sent.popleft()
+			return sum([ n for (stamp, n) in self.sent ]) / (2 * self.WINDOW)
+
+	def admit(self, running):
+		"""
+		Whether to start another transfer with 'running' already
+		going. The caller counts the one it starts into 'running'
+		under the same lock.
+		"""
+		if not self.total:
+			return True
+
+		rate = self.recent()
+		with self.lock:
+			now = time.time()
+			if now - self.opened >= self.WINDOW:
+				self.opened   = now
+				self.admitted = 0
+			if running and rate >= 0.9 * self.total.rate:
+				return False
+			if running and self.admitted >= max(1, running - self.admitted):
+				return False
+			self.admitted += 1
+			return True
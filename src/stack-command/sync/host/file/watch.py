@@ -0,0 +1,258 @@
+#
+# @SI_Copyright@
+# @SI_Copyright@
+#
+
+#
+# Watch a file or a directory tree for changes. On Linux this uses
+# inotify through ctypes, one watch per directory; anywhere that
+# fails it falls back to polling the tree for changed mtimes.
+#
+
+import os
+import time
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+import fnmatch
+
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+IN_CLOEXEC     = 0o2000000
+
+MASK  = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+	IN_CREATE | IN_DELETE
+EVENT = struct.Struct('iIII')
+
+#
+# editor scratch files, never worth a push
+#
+IGNORE = [ '.*.sw?', '*~', '.#*', '4913' ]
+
+
+def ignored(path):
+	name = os.path.basename(path)
+	return any([ fnmatch.fnmatch(name, pattern) for pattern in IGNORE ])
+
+
+def walk(root):
+	"""
+	Every directory and file under 'root' as (path, isdir).
+	"""
+	yield (root, True)
+	for (path, dirs, files) in os.walk(root):
+		for name in dirs:
+			yield (os.path.join(path, name), True)
+		for name in files:
+			yield (os.path.join(path, name), False)
+
+
+class Inotify(object):
+	"""
+	Changes under 'root' from inotify. If 'only' is set just that
+	file in 'root' is reported.
+	"""
+
+	def __init__(self, root, only=None):
+		self.root  = root
+		self.only  = only
+		self.libc  = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+					 use_errno=True)
+		self.fd    = self.libc.inotify_init1(IN_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+		self.dirs  = {}
+		self.add(root)
+
+	def add(self, top):
+		"""
+		Watch 'top' and every directory below it, returning what is
+		already in there: files can land in a new directory before
+		we watch it.
+		"""
+		found = []
+		for (path, isdir) in walk(top):
+			if not isdir:
+				found.append((path, False, False))
+				continue
+			wd = self.libc.inotify_add_watch(self.fd, path.encode(), MASK)
+			if wd < 0:
+				if ctypes.get_errno() not in [ errno.ENOENT, errno.ENOTDIR ]:
+					raise OSError(ctypes.get_errno(), 'can not watch %s' % path)
+				continue
+			self.dirs[wd] = path
+			if self.only:
+				break
+		return found
+
+	def read(self, timeout):
+		"""
+		Wait up to 'timeout' seconds (None is forever) and return
+		the changes as (path, isdir, gone) tuples.
+		"""
+		(ready, _, _) = select.select([ self.fd ], [], [], timeout)
+		if not ready:
+			return []
+
+		data    = os.read(self.fd, 64 * 1024)
+		changes = []
+		offset  = 0
+		while offset < len(data):
+			(wd, mask, cookie, size) = EVENT.unpack_from(data, offset)
+			name    = data[offset + EVENT.size:offset + EVENT.size + size]
+			offset += EVENT.size + size
+
+			if mask & IN_Q_OVERFLOW:
+				changes.extend(self.add(self.root))
+				continue
+			if mask & IN_IGNORED:
+				self.dirs.pop(wd, None)
+				continue
+			if wd not in self.dirs:
+				continue
+
+			path  = os.path.join(self.dirs[wd], name.rstrip(b'\0').decode())
+			isdir = bool(mask & IN_ISDIR)
+			if self.only and os.path.basename(path) != self.only:
+				continue
+			if mask & (IN_DELETE | IN_MOVED_FROM):
+				changes.append((path, isdir, True))
+			elif isdir and mask & (IN_CREATE | IN_MOVED_TO):
+				changes.extend(self.add(path))
+			elif not isdir:
+				changes.append((path, False, False))
+		return changes
+
+	def close(self):
+		os.close(self.fd)
+
+
+class Poller(object):
+	"""
+	Same as Inotify by comparing the tree every 'interval' seconds.
+	"""
+
+	def __init__(self, root, only=None, interval=1.0):
+		self.root     = root
+		self.only     = only
+		self.interval = interval
+		self.seen     = self.scan()
+
+	def scan(self):
+		seen = {}
+		if self.only:
+			paths = [ (os.path.join(self.root, self.only), False) ]
+		else:
+			paths = walk(self.root)
+		for (path, isdir) in paths:
+			try:
+				st = os.lstat(path)
+			except OSError:
+				continue
+			seen[path] = (isdir, st.st_mtime_ns, st.st_size, st.st_mode)
+		return seen
+
+	def read(self, timeout):
+		if timeout is None or timeout > self.interval:
+			timeout = self.interval
+		time.sleep(timeout)
+
+		seen    = self.scan()
+		changes = []
+		for (path, state) in seen.items():
+			if not state[0] and self.seen.get(path) != state:
+				changes.append((path, False, False))
+		for (path, state) in self.seen.items():
+			if path not in seen:
+				changes.append((path, state[0], True))
+		self.seen = seen
+		return changes
+
+	def close(self):
+		pass
+
+
+def watcher(src):
+	"""
+	A watcher for file or directory 'src', Inotify where we can.
+	"""
+	src  = os.path.abspath(src.rstrip('/'))
+	only = None
+	if not os.path.isdir(src):
+		(src, only) = os.path.split(src)
+	try:
+		return Inotify(src, only)
+	except (OSError, AttributeError):
+		return Poller(src, only)
+
+
+class Batcher(object):
+	"""
+	Groups the changes a watcher reports into batches: one is ready
+	once nothing has changed for 'debounce' seconds, or 'longest'
+	seconds after its first change if the edits never stop.
+	"""
+
+	def __init__(self, watcher, debounce, longest=None):
+		self.watcher  = watcher
+		self.debounce = debounce
+		self.longest  = longest or 10 * debounce
+		self.pending  = {}
+		self.first    = None
+		self.last     = None
+
+	def next(self, timeout=None):
+		"""
+		Wait up to 'timeout' seconds for a batch and return it as
+		(changed, removed) lists of (path, isdir), or None if there
+		wasn't one in time.
+		"""
+		end = None if timeout is None else time.time() + timeout
+		while True:
+			now   = time.time()
+			waits = []
+			if self.first is not None:
+				due = min(self.last + self.debounce, self.first + self.longest)
+				if now >= due:
+					return self.flush()
+				waits.append(due - now)
+			if end is not None:
+				if now >= end:
+					return None
+				waits.append(end - now)
+
+			wait = min(waits) if waits else None
+			for (path, isdir, gone) in self.watcher.read(wait):
+				if ignored(path):
+					continue
+				self.pending[path] = (isdir, gone)
+				self.last = time.time()
+				if self.first is None:
+					self.first = self.last
+
+	def flush(self):
+		#
+		# what counts is how things ended up: a file written
+		# and removed within the batch is just removed
+		#
+		changed = []
+		removed = []
+		for (path, (isdir, gone)) in sorted(self.pending.items()):
+			if os.path.lexists(path):
+				if not isdir and os.path.isfile(path):
+					changed.append((path, False))
+			else:
+				removed.append((path, isdir))
+		self.pending = {}
+		self.first   = None
+		self.last    = None
+		return (changed, removed)